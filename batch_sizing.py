@@ -0,0 +1,121 @@
+import json
+import logging
+import math
+import os
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class BatchSizeTuner:
+    # Hill-climbs one table's batch size toward the best measured throughput: keeps
+    # stepping in the same direction while rows/sec improves on the best size so far,
+    # and otherwise turns around from the best size with a smaller step. Once the step
+    # is too small to matter it settles on the best size. A batch slower than
+    # max_seconds shrinks the size straight away so transactions (and the locks they
+    # hold) stay short.
+    def __init__(self, name, initial_size, min_size, max_size, step=2.0, min_step=1.15, max_seconds=30.0, tolerance=0.05):
+        self.name = name
+        self.min_size = min_size
+        self.max_size = max(min_size, max_size)
+        self.size = self._clamp(initial_size)
+        self.step = step
+        self.min_step = min_step
+        self.max_seconds = max_seconds
+        self.tolerance = tolerance
+        self.direction = 1
+        self.settled = False
+        self.best_size = self.size
+        self.best_rate = 0.0
+        self.lock = threading.Lock()
+
+    def _clamp(self, size):
+        return int(min(self.max_size, max(self.min_size, size)))
+
+    def observe(self, rows, seconds):
+        with self.lock:
+            if seconds <= 0:
+                return
+            if seconds > self.max_seconds and self.size > self.min_size:
+                self.size = self._clamp(self.size / self.step)
+                self.direction = -1
+                self.best_size, self.best_rate = self.size, 0.0
+                logger.info(f"Batch for {self.name} took {seconds:.1f}s; shrinking batches to {self.size} rows")
+                return
+            if self.settled or rows < self.size:
+                # A short (last) batch isn't comparable with full ones
+                return
+
+            rate = rows / seconds
+            if rate > self.best_rate * (1 + self.tolerance):
+                self.best_size, self.best_rate = self.size, rate
+            else:
+                self.direction = -self.direction
+                self.step = math.sqrt(self.step)
+            if self.step < self.min_step:
+                self.size = self.best_size
+                self.settled = True
+                logger.info(f"Settled on {self.size} rows per batch for {self.name} ({self.best_rate:.0f} rows/sec)")
+                return
+
+            size = self._clamp(self.best_size * self.step ** self.direction)
+            if size == self.best_size:
+                # Pinned against a bound: try the other way
+                self.direction = -self.direction
+                size = self._clamp(self.best_size * self.step ** self.direction)
+            self.size = size
+
+
+class BatchSizes:
+    # One tuner per (writer, table), started from the size the last run settled on when
+    # a path is given, and written back there by save(). With adaptive=False every
+    # table just uses the writer's fixed batch_size.
+    def __init__(self, path=None, adaptive=True):
+        self.path = path
+        self.adaptive = adaptive
+        self.tuners = {}
+        self.lock = threading.Lock()
+        self.persisted = self._load_file()
+
+    def _load_file(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable batch size file {self.path}: {e}")
+            return {}
+
+    def tuner(self, writer, table):
+        key = f"{writer.name}:{table.fullname}"
+        with self.lock:
+            if key not in self.tuners:
+                max_size = writer.max_batch_size
+                if not self.adaptive:
+                    size = min(writer.batch_size, max_size)
+                    self.tuners[key] = BatchSizeTuner(key, size, size, size)
+                    self.tuners[key].settled = True
+                else:
+                    # A size saved by an earlier run is already close, so search around it in smaller steps
+                    step = math.sqrt(2) if key in self.persisted else 2.0
+                    initial_size = self.persisted.get(key, writer.batch_size)
+                    self.tuners[key] = BatchSizeTuner(key, initial_size, writer.min_batch_size, max_size, step=step)
+                    logger.info(f"Starting {key} at {self.tuners[key].size} rows per batch (at most {max_size})")
+            return self.tuners[key]
+
+    def report(self):
+        for key, tuner in self.tuners.items():
+            state = 'settled' if tuner.settled else 'still adjusting'
+            logger.info(f"Batch size for {key}: {tuner.size} rows ({state}, best {tuner.best_rate:.0f} rows/sec)")
+
+    def save(self):
+        if not self.path or not self.adaptive:
+            return
+        with self.lock:
+            self.persisted.update({key: tuner.size for key, tuner in self.tuners.items()})
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w') as f:
+                json.dump(self.persisted, f, indent=2, sort_keys=True)
+            os.replace(temp_path, self.path)
+        logger.info(f"Saved batch sizes to {self.path}")
@@ -0,0 +1,210 @@
+# End-to-end benchmark that runs without Snowflake or SQL Server: extracts come from
+# a fake Snowflake cursor serving synthetic mart data and loads go into a local SQLite
+# database with the hrsa tables. Times the full main() flow and each JetsonDatasource
+# insert path at each scale, and writes the results as JSON keyed by commit so runs
+# from different commits can be compared.
+#
+#   python benchmarks/offline_transfer.py --rows 10000 100000 1000000 --output results.json
+#   python benchmarks/offline_transfer.py --rows 10000 100000 --baseline results.json
+import argparse
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import pandas as pd
+import sqlalchemy
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+import main as transfer_main
+from bulk_writer import create_writer
+from id_index import CoveredEntityIndex
+from jetson_connection import JetsonDatasource
+from schema_cache import SchemaCache
+from instrumentation import dataframe_bytes
+from snowflake_connection import ENTITY_SCHEMAS, ID, SnowflakeDatasource
+from stand_ins import FakeSnowflakeConnection, create_hrsa_engine, make_marts
+
+INSERT_PATHS = [
+    # Covered entities first: the other paths look their covered entity IDs up
+    ('covered_entities', 'insert_covered_entities'),
+    ('covered_entity_identifiers', 'insert_covered_entity_identifiers'),
+    ('ce_parents', 'insert_ce_parents'),
+    ('contract_pharmacies', 'insert_contract_pharmacies'),
+]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def result(case, rows, seconds, rows_processed=None, **extra):
+    # rows is the scale the case ran at; throughput is over the rows it actually processed
+    rows_processed = rows if rows_processed is None else rows_processed
+    return dict(case=case, rows=rows, seconds=round(seconds, 4),
+                rows_per_second=round(rows_processed / seconds, 1) if seconds else 0.0, **extra)
+
+
+def bench_main(marts, rows, writer, stream, chunk_size, work_dir, case='main', extra_arguments=()):
+    # Run main() as the command line would, with its connection factories pointed at the stand-ins.
+    # Every case at a scale shares one extract cache, so a --load-only case replays the extracts of the main case.
+    engine = create_hrsa_engine(tempfile.mkdtemp(dir=work_dir))
+    transfer_main.load_environment_variables = lambda env: None
+    transfer_main.create_snowflake_engine = lambda: FakeSnowflakeConnection(marts, batch_size=chunk_size)
+    transfer_main.create_sql_server_engine = lambda fast_executemany=False: engine
+    os.environ.setdefault('SNOWFLAKE_DATABASE', 'benchmark')
+    os.environ.setdefault('JETSONS_USER_ID', '0')
+
+    report_path = os.path.join(work_dir, f"{case}_{rows}.json")
+    # One stage loads at a time: SQLite serializes writers, so parallel loads would only contend for its lock
+    arguments = ['--writer', writer, '--workers', '1', '--chunk-size', str(chunk_size), '--run-report', report_path,
+                 '--sync-state', os.path.join(work_dir, f"sync_state_{case}_{rows}.json"),
+                 '--journal', os.path.join(work_dir, f"batch_journal_{case}_{rows}.sqlite"),
+                 '--batch-sizes', os.path.join(work_dir, f"batch_sizes_{rows}.json"),
+                 '--extract-cache', os.path.join(work_dir, f"extract_cache_{rows}"), *extra_arguments]
+    if stream:
+        arguments.append('--stream')
+    options = transfer_main.build_parser().parse_args(arguments)
+
+    started = time.perf_counter()
+    transfer_main.main('benchmark', options)
+    seconds = time.perf_counter() - started
+
+    with open(report_path) as f:
+        report = json.load(f)
+    stages = {name: stage['pipeline'] for name, stage in report['stages'].items() if stage['pipeline']}
+    total_rows = sum(stage['rows'] for stage in stages.values())
+    return result(case, rows, seconds, rows_processed=total_rows, rows_transferred=total_rows,
+                  peak_memory_bytes=report['run']['peak_memory_bytes'], stages=stages)
+
+
+def bench_inserts(marts, rows, writer, work_dir):
+    # Each insert path on its own, fed the cleaned frames main() would pass it
+    engine = create_hrsa_engine(tempfile.mkdtemp(dir=work_dir))
+    snowflake_datasource = SnowflakeDatasource(FakeSnowflakeConnection(marts), 'benchmark')
+    schema_cache = SchemaCache(engine)
+    jetson_datasource = JetsonDatasource(engine, '0', writer=create_writer(writer), schema_cache=schema_cache,
+                                         id_index=CoveredEntityIndex(schema_cache))
+    results = []
+    for entity, insert in INSERT_PATHS:
+        df = getattr(snowflake_datasource, f"get_{entity}")()
+        started = time.perf_counter()
+        inserted = getattr(jetson_datasource, insert)(df)
+        seconds = time.perf_counter() - started
+        if inserted is None:
+            raise RuntimeError(f"{insert} failed")
+        results.append(result(insert, rows, seconds))
+    return results
+
+
+def bench_memory(marts, rows):
+    # Footprint of each cleaned extract with its typed dtypes, against the same columns
+    # held as Python string objects (what the cleaners used to return)
+    snowflake_datasource = SnowflakeDatasource(FakeSnowflakeConnection(marts), 'benchmark')
+    results = []
+    for entity, _ in INSERT_PATHS:
+        df = getattr(snowflake_datasource, f"get_{entity}")()
+        object_df = df.astype({column: object for column, dtype in ENTITY_SCHEMAS[entity].items() if dtype != ID})
+        results.append(dict(entity=entity, rows=rows, object_bytes=dataframe_bytes(object_df), typed_bytes=dataframe_bytes(df)))
+    return results
+
+
+def compare(results, baseline, tolerance):
+    # Flag every case that got slower than the baseline by more than the tolerance
+    baseline_results = {(r['case'], r['rows']): r for r in baseline['results']}
+    regressions = []
+    print(f"\nCompared with {baseline['commit']}:")
+    print(f"{'case':<36}{'rows':>10}{'baseline rows/s':>18}{'rows/s':>12}{'change':>10}")
+    for r in results:
+        previous = baseline_results.get((r['case'], r['rows']))
+        if previous is None or not previous['rows_per_second']:
+            continue
+        change = r['rows_per_second'] / previous['rows_per_second'] - 1
+        flag = '  REGRESSION' if change < -tolerance else ''
+        print(f"{r['case']:<36}{r['rows']:>10}{previous['rows_per_second']:>18.0f}{r['rows_per_second']:>12.0f}{change:>+9.0%}{flag}")
+        if flag:
+            regressions.append(r)
+    return regressions
+
+
+def main(row_counts, writer, stream, chunk_size, seed, output, baseline, tolerance):
+    # Keep the per-batch progress logging of the transfer itself out of the results table
+    logging.getLogger().setLevel(logging.WARNING)
+    results = []
+    memory = []
+    with tempfile.TemporaryDirectory(prefix='offline_transfer_') as work_dir:
+        print(f"{'case':<36}{'rows':>10}{'seconds':>10}{'rows/s':>12}")
+        for rows in row_counts:
+            marts = make_marts(rows, seed)
+            cases = bench_inserts(marts, rows, writer, work_dir)
+            cases.append(bench_main(marts, rows, writer, stream, chunk_size, work_dir))
+            # A complete load drops its cached extracts; a dry run leaves them for --load-only to replay
+            bench_main(marts, rows, writer, stream, chunk_size, work_dir, 'dry_run', ['--dry-run'])
+            cases.append(bench_main(marts, rows, writer, stream, chunk_size, work_dir, 'main_load_only', ['--load-only']))
+            for r in cases:
+                print(f"{r['case']:<36}{r['rows']:>10}{r['seconds']:>10.2f}{r['rows_per_second']:>12.0f}")
+                results.append(r)
+            memory.extend(bench_memory(marts, rows))
+
+    print(f"\n{'cleaned extract':<36}{'rows':>10}{'object MB':>12}{'typed MB':>12}{'saved':>8}")
+    for m in memory:
+        print(f"{m['entity']:<36}{m['rows']:>10}{m['object_bytes'] / 2**20:>12.1f}{m['typed_bytes'] / 2**20:>12.1f}"
+              f"{1 - m['typed_bytes'] / m['object_bytes']:>8.0%}")
+
+    benchmark = {
+        'commit': git_commit(),
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'settings': {'writer': writer, 'stream': stream, 'chunk_size': chunk_size, 'seed': seed},
+        'environment': {
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'sqlalchemy': sqlalchemy.__version__,
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+        },
+        'results': results,
+        'memory': memory,
+    }
+    if output:
+        with open(output, 'w') as f:
+            json.dump(benchmark, f, indent=2)
+        print(f"\nWrote results to {output}")
+
+    if baseline:
+        with open(baseline) as f:
+            baseline_benchmark = json.load(f)
+        if baseline_benchmark['settings'] != benchmark['settings']:
+            print(f"Warning: baseline was run with different settings {baseline_benchmark['settings']}")
+        if compare(results, baseline_benchmark, tolerance):
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the transfer against local stand-ins for Snowflake and SQL Server.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help="Rows per entity at each scale")
+    parser.add_argument('--writer', default='executemany', choices=['executemany', 'fast_executemany'],
+                        help="Bulk writer to load SQLite with (tvp and bcp need SQL Server)")
+    parser.add_argument('--stream', action='store_true', help="Stream the extracts in chunks in the main() run")
+    parser.add_argument('--chunk-size', type=int, default=100000)
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--output', default=None, help="JSON file to write the results to")
+    parser.add_argument('--baseline', default=None,
+                        help="Results JSON from an earlier commit; exits non-zero if any case regressed")
+    parser.add_argument('--tolerance', type=float, default=0.15,
+                        help="Allowed drop in rows/sec before a case counts as a regression")
+    args = parser.parse_args()
+
+    sys.exit(main(args.rows, args.writer, args.stream, args.chunk_size, args.seed, args.output, args.baseline, args.tolerance))
@@ -0,0 +1,125 @@
+# Micro-benchmark for the record preparation done before each insert: ID assignment,
+# duplicate filtering and building driver parameters. Compares the original per-row
+# loops (apply/to_dict/iterrows) with the vectorized versions used by JetsonDatasource.
+#
+#   python benchmarks/record_prep.py --rows 100000 1000000
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bulk_writer import dataframe_rows
+
+COVERED_ENTITY_COLUMNS = [
+    'ID', 'id340B', 'entityName', 'entitySubDivisionName', 'entityType', 'address1', 'address2',
+    'city', 'st', 'zip', 'secondZip', 'medicareProviderNumber', 'grantNumber', 'lastUpdatedDate',
+]
+
+
+def make_covered_entities(rows, rng):
+    return pd.DataFrame({
+        'id340B': [f"DSH{i:08d}" for i in range(rows)],
+        'entityName': [f"Covered Entity {i}" for i in range(rows)],
+        'entitySubDivisionName': None,
+        'entityType': rng.choice(['DSH', 'CAH', 'FQHC', 'RRC'], rows),
+        'address1': [f"{i} Main St" for i in range(rows)],
+        'address2': None,
+        'city': rng.choice(['Minneapolis', 'St Paul', 'Duluth'], rows),
+        'st': rng.choice(['MN', 'WI', 'IA'], rows),
+        'zip': '55401',
+        'medicareProviderNumber': None,
+    })
+
+
+def make_ce_parents(rows, rng):
+    return pd.DataFrame({
+        'CEKeyIDParent': rng.integers(1, rows, rows).astype(float),
+        'CEKeyIDChild': np.arange(1, rows + 1, dtype=float),
+    })
+
+
+def covered_entities_loop(df, existing_keys, latest_id):
+    df = df.copy()
+    df['ID'] = df.index + 1
+    df['ID'] = df['ID'].apply(lambda x: latest_id + x)
+    df['grantNumber'] = None
+    df['secondZip'] = None
+    df['lastUpdatedDate'] = datetime.now()
+    records = df[COVERED_ENTITY_COLUMNS].to_dict(orient='records')
+    new_records = []
+    for record in records:
+        if record['id340B'] not in existing_keys:
+            new_records.append(record)
+    return new_records
+
+
+def covered_entities_vectorized(df, existing_keys, latest_id):
+    df = df.copy()
+    df['ID'] = None
+    df['grantNumber'] = None
+    df['secondZip'] = None
+    df['lastUpdatedDate'] = datetime.now()
+    df = df[COVERED_ENTITY_COLUMNS]
+    new_df = df[~df['id340B'].isin(existing_keys)].copy()
+    new_df['ID'] = np.arange(latest_id + 1, latest_id + 1 + len(new_df))
+    return dataframe_rows(new_df, COVERED_ENTITY_COLUMNS)
+
+
+def ce_parents_loop(df, existing_relationships):
+    existing = set(existing_relationships)
+    new_records = []
+    for _, row in df.iterrows():
+        relationship = (row['CEKeyIDParent'], row['CEKeyIDChild'])
+        if relationship not in existing:
+            new_records.append(relationship)
+    return [{'CEKeyIDParent': parent, 'CEKeyIDChild': child} for parent, child in new_records]
+
+
+def ce_parents_vectorized(df, existing_relationships):
+    df = df.astype({'CEKeyIDParent': 'int64', 'CEKeyIDChild': 'int64'})
+    existing = pd.MultiIndex.from_tuples(existing_relationships, names=['CEKeyIDParent', 'CEKeyIDChild'])
+    is_duplicate = pd.MultiIndex.from_frame(df[['CEKeyIDParent', 'CEKeyIDChild']]).isin(existing)
+    return dataframe_rows(df[~is_duplicate], ['CEKeyIDParent', 'CEKeyIDChild'])
+
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, len(result)
+
+
+def main(row_counts, duplicate_fraction, seed):
+    rng = np.random.default_rng(seed)
+    print(f"{'case':<20}{'rows':>10}{'loop (s)':>12}{'vectorized (s)':>16}{'speedup':>10}")
+    for rows in row_counts:
+        covered_entities_df = make_covered_entities(rows, rng)
+        existing_keys = set(covered_entities_df['id340B'].sample(frac=duplicate_fraction, random_state=seed))
+        loop_seconds, loop_rows = timed(covered_entities_loop, covered_entities_df, existing_keys, 1000)
+        vectorized_seconds, vectorized_rows = timed(covered_entities_vectorized, covered_entities_df, existing_keys, 1000)
+        assert loop_rows == vectorized_rows
+        print(f"{'covered entities':<20}{rows:>10}{loop_seconds:>12.2f}{vectorized_seconds:>16.2f}{loop_seconds / vectorized_seconds:>9.1f}x")
+
+        ce_parents_df = make_ce_parents(rows, rng)
+        sample = ce_parents_df.sample(frac=duplicate_fraction, random_state=seed).astype('int64')
+        existing_relationships = list(sample.itertuples(index=False, name=None))
+        loop_seconds, loop_rows = timed(ce_parents_loop, ce_parents_df, existing_relationships)
+        vectorized_seconds, vectorized_rows = timed(ce_parents_vectorized, ce_parents_df, existing_relationships)
+        assert loop_rows == vectorized_rows
+        print(f"{'CE parents':<20}{rows:>10}{loop_seconds:>12.2f}{vectorized_seconds:>16.2f}{loop_seconds / vectorized_seconds:>9.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare per-row and vectorized record preparation.")
+    parser.add_argument('--rows', type=int, nargs='+', default=[100000, 1000000],
+                        help="Row counts to benchmark")
+    parser.add_argument('--duplicate-fraction', type=float, default=0.1,
+                        help="Fraction of incoming rows that already exist in the target table")
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    main(args.rows, args.duplicate_fraction, args.seed)
@@ -0,0 +1,147 @@
+# Local stand-ins for the two databases, used by the offline benchmarks: a fake
+# Snowflake connection that answers the SnowflakeDatasource extract queries with
+# synthetic mart-shaped data, and a SQLite engine with the hrsa tables attached as a
+# schema so JetsonDatasource can write to it unchanged.
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from sqlalchemy import create_engine, event
+
+HRSA_TABLES = [
+    """CREATE TABLE hrsa.coveredentity (
+        ID INTEGER PRIMARY KEY, id340B VARCHAR(50), entityName VARCHAR(255), entitySubDivisionName VARCHAR(255),
+        entityType VARCHAR(50), address1 VARCHAR(255), address2 VARCHAR(255), city VARCHAR(100), st VARCHAR(2),
+        zip VARCHAR(10), secondZip VARCHAR(10), medicareProviderNumber VARCHAR(50), grantNumber VARCHAR(50),
+        lastUpdatedDate DATETIME
+    )""",
+    "CREATE INDEX hrsa.ix_coveredentity_id340B ON coveredentity (id340B)",
+    """CREATE TABLE hrsa.ceparentchild (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT, CEKeyIDParent INTEGER, CEKeyIDChild INTEGER
+    )""",
+    """CREATE TABLE hrsa.coveredentityidentifier (
+        id INTEGER PRIMARY KEY, coveredEntityKeyId INTEGER, identifierType VARCHAR(50), identifier VARCHAR(100),
+        userCreated BOOLEAN, lastUpdatedDate DATETIME, activeFlag BOOLEAN
+    )""",
+    "CREATE INDEX hrsa.ix_coveredentityidentifier_key ON coveredentityidentifier (coveredEntityKeyId, identifier)",
+    """CREATE TABLE hrsa.contractpharmacy (
+        id INTEGER PRIMARY KEY, HRSAPHARMACYNAME VARCHAR(255), HRSAADDRESS1 VARCHAR(255), city VARCHAR(100),
+        st VARCHAR(2), zip VARCHAR(10), secondZip VARCHAR(10), ncpdp VARCHAR(20), lastUpdatedDate DATETIME
+    )""",
+    # As created by sql/create_id_reservation.sql
+    "CREATE TABLE hrsa.id_reservation (table_name VARCHAR(256) NOT NULL PRIMARY KEY, next_id BIGINT NOT NULL)",
+]
+
+
+def create_hrsa_engine(directory=None):
+    # SQLite file database with a second database attached as the hrsa schema on every
+    # pooled connection
+    directory = directory or tempfile.mkdtemp(prefix='hrsa_')
+    # SQLite allows one writer at a time; wait for the lock rather than failing fast
+    engine = create_engine(f"sqlite:///{os.path.join(directory, 'main.db')}", connect_args={'timeout': 120})
+
+    @event.listens_for(engine, 'connect')
+    def attach_hrsa(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"ATTACH DATABASE '{os.path.join(directory, 'hrsa.db')}' AS hrsa")
+
+    with engine.begin() as connection:
+        for statement in HRSA_TABLES:
+            connection.exec_driver_sql(statement)
+    return engine
+
+
+def make_marts(rows, seed=42):
+    # Extract results shaped like the Snowflake marts (upper-case column names, as
+    # fetch_pandas_all returns them), each with `rows` rows
+    rng = np.random.default_rng(seed)
+    id340B = np.array([f"DSH{i:08d}" for i in range(rows)], dtype=object)
+    covered_entities = pd.DataFrame({
+        'COVERED_ENTITY_KEY_ID': np.arange(1, rows + 1),
+        'CE_340B_ID': id340B,
+        'COVERED_ENTITY_NAME': [f"Covered Entity {i}" for i in range(rows)],
+        'ENTITY_SUBDIVISION_NAME': None,
+        'COVERED_ENTITY_TYPE': rng.choice(['DSH', 'CAH', 'FQHC', 'RRC'], rows),
+        'ADDRESS_STREET_1': [f"{i} Main St" for i in range(rows)],
+        'ADDRESS_STREET_2': None,
+        'ADDRESS_CITY': rng.choice(['Minneapolis', 'St Paul', 'Duluth'], rows),
+        'ADDRESS_STATE': rng.choice(['MN', 'WI', 'IA'], rows),
+        'ADDRESS_ZIP': '55401',
+        'MEDICARE_PROVIDER_NUMBER': None,
+        'SOURCE': 'springfield',
+    })
+    covered_entity_identifiers = pd.DataFrame({
+        'IDENTIFIER_FIELD_NAME': rng.choice(['npi', 'medicare_provider_number', 'grant_number'], rows),
+        'CROSSWALKED_IDENTIFIER_FIELD_VALUE': [f"{i:010d}" for i in range(rows)],
+        'CE_340B_ID': id340B[rng.integers(0, rows, rows)],
+    })
+    contract_pharmacies = pd.DataFrame({
+        'CONTRACT_PHARMACY_KEY_ID': np.arange(1, rows + 1),
+        'VALUE': np.arange(1, rows + 1),
+        'PHARMACY_NAME': [f"Pharmacy {i}" for i in range(rows)],
+        'ADDRESS_STREET_1': [f"{i} Market St" for i in range(rows)],
+        'ADDRESS_CITY': rng.choice(['Minneapolis', 'St Paul', 'Duluth'], rows),
+        'ADDRESS_STATE': rng.choice(['MN', 'WI', 'IA'], rows),
+        'ADDRESS_ZIP': '55401',
+        'ADDRESS_ZIP4': None,
+        'CONTRACT_PHARMACY_NCPDP': [f"{i:07d}" for i in range(rows)],
+    })
+    ce_parents = pd.DataFrame({
+        'CE_340B_ID': id340B,
+        'PARENT_CE_340B_ID': id340B[rng.integers(0, rows, rows)],
+        'COVERED_ENTITY_KEY_ID': np.arange(1, rows + 1),
+    })
+    return {
+        'covered_entities': covered_entities,
+        'covered_entity_identifiers': covered_entity_identifiers,
+        'contract_pharmacies': contract_pharmacies,
+        'ce_parents': ce_parents,
+    }
+
+
+class FakeSnowflakeCursor:
+    def __init__(self, marts, batch_size):
+        self.marts = marts
+        self.batch_size = batch_size
+        self.query = None
+
+    def execute(self, query, params=None):
+        self.query = query.lower()
+        return self
+
+    def _result(self):
+        # Tell the extract queries apart by the mart and columns they select
+        if 'identifier_crosswalk' in self.query:
+            return self.marts['covered_entity_identifiers']
+        if 'mart_contract_pharmacies' in self.query:
+            return self.marts['contract_pharmacies']
+        if 'parent_ce_340b_id' in self.query:
+            return self.marts['ce_parents']
+        return self.marts['covered_entities']
+
+    def fetchone(self):
+        # Only the watermark query fetches a single row: the highest key in the mart
+        return (len(self._result()),)
+
+    def fetch_pandas_all(self):
+        return self._result().copy()
+
+    def fetch_pandas_batches(self):
+        result = self._result()
+        for i in range(0, len(result), self.batch_size):
+            yield result.iloc[i:i + self.batch_size].reset_index(drop=True)
+
+    def close(self):
+        pass
+
+
+class FakeSnowflakeConnection:
+    def __init__(self, marts, batch_size=100000):
+        self.marts = marts
+        self.batch_size = batch_size
+
+    def cursor(self):
+        return FakeSnowflakeCursor(self.marts, self.batch_size)
+
+    def close(self):
+        pass
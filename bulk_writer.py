@@ -0,0 +1,230 @@
+import hashlib
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+import time
+from datetime import date, datetime
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+# SQL Server rejects statements with more bound parameters than this
+SQL_SERVER_MAX_PARAMETERS = 2100
+
+
+class BulkWriter:
+    # Base class for the strategies JetsonDatasource uses to push a batch of rows
+    # (a list of tuples ordered like `columns`) into a table. Each strategy keeps
+    # per-table row counts and timings so runs can be compared by rows/sec.
+    name = None
+    batch_size = 1000
+    # Range adaptive batch sizing may move batch_size within
+    min_batch_size = 100
+    max_batch_size = 100000
+    # False when the writer loads through its own session (e.g. bcp), so it
+    # cannot see the caller's temp tables or take part in its transaction
+    session_bound = True
+
+    def __init__(self, batch_size=None):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        self.stats = {}
+        self.stats_lock = threading.Lock()
+
+    def write(self, connection, table, columns, rows):
+        if not rows:
+            return 0
+        started = time.perf_counter()
+        self._write(connection, table, columns, rows)
+        elapsed = time.perf_counter() - started
+        with self.stats_lock:
+            table_stats = self.stats.setdefault(table.fullname, {'rows': 0, 'batches': 0, 'seconds': 0.0})
+            table_stats['rows'] += len(rows)
+            table_stats['batches'] += 1
+            table_stats['seconds'] += elapsed
+        return len(rows)
+
+    def _write(self, connection, table, columns, rows):
+        raise NotImplementedError
+
+    def rows_per_second(self, table_name=None):
+        with self.stats_lock:
+            stats = [self.stats[table_name]] if table_name else list(self.stats.values())
+        rows = sum(s['rows'] for s in stats)
+        seconds = sum(s['seconds'] for s in stats)
+        return rows / seconds if seconds else 0.0
+
+    def report(self):
+        for table_name, table_stats in self.stats.items():
+            logger.info(
+                f"[{self.name}] {table_name}: {table_stats['rows']} rows in {table_stats['batches']} batches, "
+                f"{table_stats['seconds']:.2f}s ({self.rows_per_second(table_name):.0f} rows/sec)"
+            )
+
+
+def dataframe_rows(df, columns):
+    # Build the parameter tuples column by column: each column is converted to plain
+    # Python values in one vectorized step (NaN/NaT -> None, numpy scalars -> int/float,
+    # Timestamp -> datetime, which not every driver can bind) and the columns are zipped
+    column_values = []
+    for column in columns:
+        series = df[column]
+        if pd.api.types.is_datetime64_any_dtype(series):
+            values = series.array.to_pydatetime()
+            values = np.where(series.isna().to_numpy(), None, values).tolist() if series.hasnans else values.tolist()
+        elif series.hasnans:
+            values = series.astype(object).where(series.notna(), None).tolist()
+        else:
+            values = series.tolist()
+        column_values.append(values)
+    return list(zip(*column_values))
+
+
+def _insert_statement(connection, table, columns, placeholders):
+    preparer = connection.dialect.identifier_preparer
+    column_list = ', '.join(preparer.quote(column) for column in columns)
+    return f"INSERT INTO {preparer.format_table(table)} ({column_list}) VALUES ({placeholders})"
+
+
+def _positional_placeholders(connection, columns):
+    paramstyle = connection.dialect.paramstyle
+    if paramstyle == 'qmark':
+        return ', '.join('?' for _ in columns)
+    if paramstyle == 'numeric':
+        return ', '.join(f':{position}' for position in range(1, len(columns) + 1))
+    return ', '.join('%s' for _ in columns)
+
+
+class ExecutemanyWriter(BulkWriter):
+    # A plain INSERT handed to the DBAPI's executemany with the batch's row tuples
+    name = 'executemany'
+    max_batch_size = 20000
+
+    def _write(self, connection, table, columns, rows):
+        insert_query = _insert_statement(connection, table, columns, _positional_placeholders(connection, columns))
+        connection.exec_driver_sql(insert_query, rows)
+
+
+class FastExecutemanyWriter(ExecutemanyWriter):
+    # The same executemany, but on SQL Server the engine is created with
+    # fast_executemany=True, which makes pyodbc bind the whole batch as a parameter
+    # array and send it in one round trip instead of one per row
+    name = 'fast_executemany'
+    batch_size = 10000
+
+
+class TableValuedParameterWriter(BulkWriter):
+    # Sends the batch as a single table-valued parameter and inserts it with one
+    # INSERT ... SELECT on the server. The user-defined table type is created on
+    # first use from the target table's column definitions.
+    name = 'tvp'
+    batch_size = 50000
+    max_batch_size = 500000
+
+    def __init__(self, batch_size=None):
+        super().__init__(batch_size)
+        self.known_types = set()
+
+    def _type_name(self, table, columns):
+        column_hash = hashlib.sha1(','.join(columns).encode()).hexdigest()[:8]
+        return f"{table.name.lstrip('#')}_tvp_{column_hash}"
+
+    def _ensure_type(self, connection, table, columns, type_schema, type_name):
+        if (type_schema, type_name) in self.known_types:
+            return
+        preparer = connection.dialect.identifier_preparer
+        column_definitions = ', '.join(
+            f"{preparer.quote(column)} {table.c[column].type.compile(dialect=connection.dialect)}"
+            for column in columns
+        )
+        connection.exec_driver_sql(
+            f"IF TYPE_ID(N'{type_schema}.{type_name}') IS NULL "
+            f"EXEC('CREATE TYPE {preparer.quote_schema(type_schema)}.{preparer.quote(type_name)} AS TABLE ({column_definitions})')"
+        )
+        self.known_types.add((type_schema, type_name))
+
+    def _write(self, connection, table, columns, rows):
+        preparer = connection.dialect.identifier_preparer
+        type_schema = table.schema or 'dbo'
+        type_name = self._type_name(table, columns)
+        self._ensure_type(connection, table, columns, type_schema, type_name)
+        column_list = ', '.join(preparer.quote(column) for column in columns)
+        insert_query = f"INSERT INTO {preparer.format_table(table)} ({column_list}) SELECT {column_list} FROM ?"
+        # pyodbc treats a leading type name and schema in the parameter list as the TVP's type
+        connection.exec_driver_sql(insert_query, ([type_name, type_schema] + [tuple(row) for row in rows],))
+
+
+class BcpWriter(BulkWriter):
+    # Stages the batch to a delimited file and loads it with the bcp utility, which
+    # uses the TDS bulk-load protocol. bcp runs in its own session and commits on
+    # its own, so it cannot load into the caller's temp tables. It always signs in with
+    # -T (Windows or Kerberos integrated authentication): with SQL authentication bcp
+    # only takes the password as -P, where any local user can read it from the process
+    # list, so the connection string's username and password are not used.
+    name = 'bcp'
+    batch_size = 250000
+    max_batch_size = 1000000
+    session_bound = False
+    field_terminator = '~|~'
+    row_terminator = '~|~\n'
+
+    def __init__(self, batch_size=None, bcp_path='bcp', staging_dir=None):
+        super().__init__(batch_size)
+        self.bcp_path = bcp_path
+        self.staging_dir = staging_dir
+
+    def _format_value(self, value):
+        if value is None or value != value:  # None or NaN
+            return ''
+        if isinstance(value, bool):
+            return '1' if value else '0'
+        if isinstance(value, datetime):
+            return value.isoformat(sep=' ', timespec='milliseconds')
+        if isinstance(value, date):
+            return value.isoformat()
+        return str(value)
+
+    def _format_file(self, table, columns):
+        # Non-XML format file mapping each field in the data file to its column's ordinal in the table
+        ordinals = {column.name: position for position, column in enumerate(table.columns, start=1)}
+        lines = ['14.0', str(len(columns))]
+        for field_number, column in enumerate(columns, start=1):
+            terminator = self.row_terminator if field_number == len(columns) else self.field_terminator
+            terminator = terminator.replace('\n', '\\n')
+            lines.append(f'{field_number}\tSQLCHAR\t0\t0\t"{terminator}"\t{ordinals[column]}\t{column}\t""')
+        return '\n'.join(lines) + '\n'
+
+    def _write(self, connection, table, columns, rows):
+        url = connection.engine.url
+        with tempfile.TemporaryDirectory(dir=self.staging_dir) as staging_dir:
+            data_path = os.path.join(staging_dir, f"{table.name}.dat")
+            format_path = os.path.join(staging_dir, f"{table.name}.fmt")
+            with open(data_path, 'w', encoding='utf-8', newline='') as data_file:
+                for row in rows:
+                    data_file.write(self.field_terminator.join(self._format_value(value) for value in row))
+                    data_file.write(self.row_terminator)
+            with open(format_path, 'w', encoding='utf-8', newline='') as format_file:
+                format_file.write(self._format_file(table, columns))
+
+            command = [
+                self.bcp_path, table.fullname, 'in', data_path, '-S', url.host, '-d', url.database, '-T',
+                '-f', format_path, '-b', str(len(rows)), '-k', '-C', '65001',
+            ]
+            result = subprocess.run(command, capture_output=True, text=True)
+            if result.returncode != 0:
+                raise RuntimeError(f"bcp failed for {table.fullname}: {result.stdout.strip()} {result.stderr.strip()}")
+
+
+WRITERS = {
+    writer.name: writer
+    for writer in (ExecutemanyWriter, FastExecutemanyWriter, TableValuedParameterWriter, BcpWriter)
+}
+
+
+def create_writer(name, **kwargs):
+    if name not in WRITERS:
+        raise ValueError(f"Unknown bulk writer: {name}. Choose from {', '.join(WRITERS)}")
+    return WRITERS[name](**kwargs)
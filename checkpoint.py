@@ -0,0 +1,131 @@
+import logging
+import random
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+from sqlalchemy.exc import DBAPIError
+
+logger = logging.getLogger(__name__)
+
+# SQLSTATEs and SQL Server error numbers worth retrying: communication link failures,
+# timeouts, deadlocks, and Azure SQL throttling / failover / resource limits
+TRANSIENT_SQLSTATES = {'08S01', '08001', '08004', 'HYT00', '40001'}
+TRANSIENT_ERROR_NUMBERS = {
+    233, 1205, 4060, 4221, 10053, 10054, 10060, 10928, 10929,
+    40143, 40197, 40501, 40540, 40613, 49918, 49919, 49920,
+}
+
+
+def is_transient(error):
+    if isinstance(error, DBAPIError) and error.connection_invalidated:
+        return True
+    original = getattr(error, 'orig', error)
+    args = getattr(original, 'args', ())
+    if args and isinstance(args[0], str) and args[0] in TRANSIENT_SQLSTATES:
+        return True
+    # pyodbc puts the native error number in parentheses, e.g. "... deadlocked ... (1205)"
+    error_numbers = {int(number) for number in re.findall(r'\((\d+)\)', str(original))}
+    return bool(error_numbers & TRANSIENT_ERROR_NUMBERS)
+
+
+def retry_transient(operation, description, retries=4, base_delay=1.0, before_retry=None):
+    # Run operation(), retrying transient database errors with jittered exponential
+    # backoff; before_retry() runs after each failure (e.g. to roll back the connection)
+    for attempt in range(retries + 1):
+        try:
+            return operation()
+        except DBAPIError as e:
+            if attempt == retries or not is_transient(e):
+                raise
+            delay = base_delay * 2 ** attempt * (1 + random.random())
+            logger.warning(f"Transient error during {description} (attempt {attempt + 1} of {retries + 1}), "
+                           f"retrying in {delay:.1f}s: {e.orig}")
+            if before_retry is not None:
+                before_retry()
+            time.sleep(delay)
+
+
+def encode_keys(df, key_columns):
+    # One string per row, the same as encode_key() gives for the row's key values
+    encoded = df[key_columns[0]].astype(str)
+    for column in key_columns[1:]:
+        encoded = encoded + '\x1f' + df[column].astype(str)
+    return encoded
+
+
+def encode_key(values):
+    return '\x1f'.join(str(value) for value in values)
+
+
+class BatchJournal:
+    # Local record of every batch committed to SQL Server: a row per batch (table, key
+    # range, row count) plus the keys it contained, in a small SQLite file. A run that
+    # fails part way leaves its journal behind; a --resume run loads it and drops rows
+    # that were already committed before doing any duplicate checks or inserts. A run
+    # that finishes, or one started without --resume, clears it.
+    def __init__(self, path=None, resume=False):
+        self.path = path
+        self.resume = resume
+        self.committed = {}
+        self.lock = threading.Lock()
+        self.journal_db = None
+        if not path:
+            return
+        self.journal_db = sqlite3.connect(path, check_same_thread=False)
+        self.journal_db.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                table_name TEXT NOT NULL, rows INTEGER NOT NULL, first_key TEXT, last_key TEXT, committed_at TEXT NOT NULL
+            )
+        """)
+        self.journal_db.execute("CREATE TABLE IF NOT EXISTS batch_keys (table_name TEXT NOT NULL, key TEXT NOT NULL)")
+        if resume:
+            for table_name, key in self.journal_db.execute("SELECT table_name, key FROM batch_keys"):
+                self.committed.setdefault(table_name, set()).add(key)
+            logger.info(f"Resuming from {path}: {sum(len(keys) for keys in self.committed.values())} rows already committed")
+        else:
+            self.clear()
+
+    def record(self, table_name, key_rows):
+        # key_rows: the key values (tuples) of the rows in a batch that was just committed
+        if self.journal_db is None:
+            return
+        keys = [encode_key(key_row) for key_row in key_rows]
+        if not keys:
+            return
+        with self.lock:
+            with self.journal_db:
+                self.journal_db.execute(
+                    "INSERT INTO batches (table_name, rows, first_key, last_key, committed_at) VALUES (?, ?, ?, ?, ?)",
+                    (table_name, len(keys), keys[0], keys[-1], datetime.now(timezone.utc).isoformat()),
+                )
+                self.journal_db.executemany("INSERT INTO batch_keys (table_name, key) VALUES (?, ?)",
+                                            [(table_name, key) for key in keys])
+
+    def skip_committed(self, table_name, df, key_columns):
+        # Rows of df whose keys were committed by the run being resumed are dropped
+        if not self.resume:
+            return df
+        with self.lock:
+            committed = self.committed.get(table_name)
+            if not committed:
+                return df
+            is_committed = encode_keys(df, key_columns).isin(committed)
+        if is_committed.any():
+            logger.info(f"Skipping {int(is_committed.sum())} rows already committed to {table_name}")
+        return df[~is_committed.to_numpy()]
+
+    def clear(self):
+        with self.lock:
+            self.committed = {}
+            if self.journal_db is None:
+                return
+            with self.journal_db:
+                self.journal_db.execute("DELETE FROM batches")
+                self.journal_db.execute("DELETE FROM batch_keys")
+
+    def close(self):
+        if self.journal_db is not None:
+            self.journal_db.close()
+            self.journal_db = None
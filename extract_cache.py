@@ -0,0 +1,175 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import pyarrow as pa
+
+logger = logging.getLogger(__name__)
+
+
+class ExtractCacheMiss(Exception):
+    pass
+
+
+class ExtractCache:
+    # Cleaned extract results kept on disk as Arrow IPC files, one per query. An entry is
+    # keyed by the Snowflake database, the query text and its parameters (which include
+    # the entity's lower watermark), and is fresh for `ttl` seconds after it was written.
+    # A run that fails, a --dry-run and a --load-only retry therefore read the same rows
+    # back through a memory map instead of querying the warehouse again, while a run
+    # after a successful sync has a new watermark and misses. Entries remember the upper
+    # watermark they were extracted up to, so a replay commits exactly that watermark.
+    # Once an entity has been loaded completely its entries are invalidated, since
+    # entities extracted without a watermark would otherwise hit the same entry again.
+    # Expired entries are deleted, and the oldest ones beyond max_bytes in total.
+    def __init__(self, path='.extract_cache', ttl=4 * 60 * 60, max_bytes=2 * 1024 ** 3, refresh=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        # With refresh, entries are only written, so every extract comes from Snowflake
+        self.refresh = refresh
+        self.lock = threading.Lock()
+        os.makedirs(path, exist_ok=True)
+
+    def key(self, entity, database, query, params):
+        # Whitespace differences in the query text don't make a different entry
+        normalized = json.dumps([database, ' '.join(query.split()), params], sort_keys=True, default=str)
+        return f"{entity}-{hashlib.sha256(normalized.encode()).hexdigest()}"
+
+    def _file(self, key):
+        return os.path.join(self.path, f"{key}.arrow")
+
+    def _is_fresh(self, file_path):
+        return time.time() - os.path.getmtime(file_path) < self.ttl
+
+    def get(self, key):
+        # The fresh entry for key as (table, metadata), or None. The table is memory mapped,
+        # so its data is only paged in as frames are converted from it.
+        file_path = self._file(key)
+        try:
+            if self.refresh or not self._is_fresh(file_path):
+                return None
+            table = pa.ipc.open_file(pa.memory_map(file_path)).read_all()
+            return table, json.loads(table.schema.metadata[b'extract_cache'])
+        except FileNotFoundError:
+            return None
+        except (OSError, KeyError, ValueError, pa.ArrowInvalid) as e:
+            logger.warning(f"Ignoring unreadable cached extract {file_path}: {e}")
+            return None
+
+    def writer(self, key, metadata):
+        return CachedExtractWriter(self, key, metadata)
+
+    def invalidate(self, entity):
+        with self.lock:
+            for name in os.listdir(self.path):
+                if name.startswith(f"{entity}-") and name.endswith('.arrow'):
+                    try:
+                        os.remove(os.path.join(self.path, name))
+                    except OSError:
+                        continue
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            for name in os.listdir(self.path):
+                file_path = os.path.join(self.path, name)
+                try:
+                    if not name.endswith('.arrow'):
+                        # Temp files left behind by a writer that never finished
+                        if name.endswith('.tmp') and time.time() - os.path.getmtime(file_path) > self.ttl:
+                            os.remove(file_path)
+                        continue
+                    if not self._is_fresh(file_path):
+                        os.remove(file_path)
+                        logger.info(f"Evicted expired cached extract {name}")
+                        continue
+                    entries.append((os.path.getmtime(file_path), os.path.getsize(file_path), file_path))
+                except OSError:
+                    # Removed by another stage, or still mapped by a reader on Windows
+                    continue
+
+            total_bytes = sum(size for _, size, _ in entries)
+            for _, size, file_path in sorted(entries):
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    continue
+                total_bytes -= size
+                logger.info(f"Evicted cached extract {os.path.basename(file_path)} to keep the cache under {self.max_bytes} bytes")
+
+
+class CachedExtractWriter:
+    # Appends frames to a new cache entry as they are extracted; the entry only replaces
+    # the previous one when close() is called after the last frame, so an interrupted
+    # extract never leaves a partial entry behind
+    def __init__(self, cache, key, metadata):
+        self.cache = cache
+        self.key = key
+        self.metadata = metadata
+        self.temp_path = os.path.join(cache.path, f"{key}.{uuid.uuid4().hex}.tmp")
+        self.sink = None
+        self.schema = None
+        self.failed = False
+
+    def write(self, df):
+        # Caching is best effort: a frame that can't be written only costs the entry
+        if self.failed:
+            return
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+            if self.sink is None:
+                # The schema is fixed by the first frame: a column that is all null there is
+                # most likely text that later frames fill in, and categoricals are stored as
+                # plain strings because every frame has its own categories (the IPC file
+                # format can't replace a dictionary). Readers re-apply the entity's dtypes.
+                schema = pa.schema([_storage_field(field) for field in table.schema])
+                self.schema = schema.with_metadata(
+                    {**(table.schema.metadata or {}), b'extract_cache': json.dumps(self.metadata, default=str).encode()}
+                )
+                table = table.cast(self.schema)
+                self.sink = pa.ipc.new_file(self.temp_path, self.schema)
+            elif not table.schema.equals(self.schema, check_metadata=False):
+                # Later chunks can infer different types (e.g. a column that was all null)
+                table = table.cast(self.schema)
+            self.sink.write_table(table)
+        except (OSError, pa.ArrowException) as e:
+            logger.warning(f"Not caching extract {self.key}: {e}")
+            self.discard()
+
+    def close(self):
+        # An extract that returned no frames (an empty stream) is not cached
+        if self.sink is None or self.failed:
+            return
+        self.sink.close()
+        os.replace(self.temp_path, self.cache._file(self.key))
+        self.cache.evict()
+
+    def discard(self):
+        self.failed = True
+        if self.sink is not None:
+            self.sink.close()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+def _storage_field(field):
+    if pa.types.is_null(field.type):
+        return field.with_type(pa.string())
+    if pa.types.is_dictionary(field.type):
+        return field.with_type(field.type.value_type)
+    return field
+
+
+def cached_frames(table, chunk_size=None):
+    # The cached table as one frame, or as frames of at most chunk_size rows
+    if chunk_size is None:
+        yield table.to_pandas()
+        return
+    for offset in range(0, table.num_rows, chunk_size):
+        yield table.slice(offset, chunk_size).to_pandas()
@@ -0,0 +1,108 @@
+import logging
+import random
+import threading
+import time
+from sqlalchemy import MetaData, Table, Column, String, BigInteger, select, insert, update, func, inspect
+from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.sql import text
+
+logger = logging.getLogger(__name__)
+
+
+class IdReservationConflict(Exception):
+    pass
+
+
+class IdReservationTableMissing(Exception):
+    pass
+
+
+class IdAllocator:
+    # Hands out contiguous ID ranges for tables whose IDs are assigned by the client.
+    # The next free ID of each table is kept in a reservation table and moved forward
+    # with a compare-and-swap in its own short transaction, so concurrent writers,
+    # threads and overlapping runs never get overlapping ranges. On SQL Server the
+    # swap is also serialized with sp_getapplock so concurrent callers queue instead
+    # of retrying. A range is never handed out twice, even if its insert later fails,
+    # so failed inserts leave gaps in the IDs. The reservation table is created ahead of
+    # time by sql/create_id_reservation.sql; the transfer login doesn't need DDL rights.
+    def __init__(self, engine, schema='hrsa', table_name='id_reservation', retries=5, lock_timeout_ms=10000):
+        self.engine = engine
+        self.retries = retries
+        self.lock_timeout_ms = lock_timeout_ms
+        self.reservations = Table(
+            table_name, MetaData(),
+            Column('table_name', String(256), primary_key=True),
+            Column('next_id', BigInteger, nullable=False),
+            schema=schema,
+        )
+        self.checked = False
+        self.lock = threading.Lock()
+
+    def _check_table(self):
+        with self.lock:
+            if self.checked:
+                return
+            reservations = self.reservations
+            if not inspect(self.engine).has_table(reservations.name, schema=reservations.schema):
+                raise IdReservationTableMissing(
+                    f"ID reservation table {reservations.fullname} does not exist; "
+                    f"create it with sql/create_id_reservation.sql before running the transfer"
+                )
+            self.checked = True
+
+    def _lock_table(self, connection, resource):
+        # Held until the reservation transaction commits or rolls back
+        result = connection.execute(text("""
+            SET NOCOUNT ON;
+            DECLARE @result INT;
+            EXEC @result = sp_getapplock @Resource = :resource, @LockMode = 'Exclusive',
+                                         @LockOwner = 'Transaction', @LockTimeout = :timeout;
+            SELECT @result;
+        """), {'resource': resource, 'timeout': self.lock_timeout_ms}).scalar()
+        if result is None or result < 0:
+            raise IdReservationConflict(f"Timed out waiting for the ID reservation lock on {resource} ({result})")
+
+    def _reserve_once(self, table, id_column, count):
+        reservations = self.reservations
+        with self.engine.connect() as connection:
+            if connection.dialect.name == 'mssql':
+                self._lock_table(connection, f"id_reservation:{table.fullname}")
+
+            next_id = connection.execute(
+                select(reservations.c.next_id).where(reservations.c.table_name == table.fullname)
+            ).scalar()
+            # IDs inserted without going through the allocator (older runs, other tools)
+            # are skipped by never starting below the table's current maximum
+            table_max = connection.execute(select(func.max(table.c[id_column]))).scalar() or 0
+            first_id = max(next_id or 0, table_max + 1)
+
+            if next_id is None:
+                connection.execute(insert(reservations).values(table_name=table.fullname, next_id=first_id + count))
+            else:
+                swapped = connection.execute(
+                    update(reservations)
+                    .where(reservations.c.table_name == table.fullname, reservations.c.next_id == next_id)
+                    .values(next_id=first_id + count)
+                ).rowcount
+                if swapped != 1:
+                    raise IdReservationConflict(f"Another writer reserved IDs for {table.fullname} first")
+            connection.commit()
+        return first_id
+
+    def reserve(self, table, id_column, count):
+        # Returns the first ID of a block of `count` consecutive IDs that is now reserved for the caller
+        if count <= 0:
+            return None
+        self._check_table()
+        for attempt in range(self.retries + 1):
+            try:
+                first_id = self._reserve_once(table, id_column, count)
+                logger.info(f"Reserved IDs {first_id}-{first_id + count - 1} for {table.fullname}")
+                return first_id
+            except (IdReservationConflict, IntegrityError, OperationalError) as e:
+                if attempt == self.retries:
+                    raise
+                delay = 0.05 * 2 ** attempt * (1 + random.random())
+                logger.warning(f"ID reservation for {table.fullname} conflicted ({e}); retrying in {delay:.2f}s")
+                time.sleep(delay)
@@ -0,0 +1,133 @@
+import logging
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import or_, select
+
+logger = logging.getLogger(__name__)
+
+
+class CoveredEntityIndex:
+    # id340B -> coveredentity.ID lookup shared by every JetsonDatasource method.
+    # The first refresh loads the whole table (or the persisted copy), and IDs assigned
+    # by insert_covered_entities are added in place with update(). After that a refresh
+    # only pulls rows with an ID above the highest one the index knows: new IDs come from
+    # the allocator, which never starts a range below the table's MAX(ID), so every row
+    # the index hasn't seen is above it. With a path, the map, the highest ID and the
+    # lastUpdatedDate high-water mark are kept in a small SQLite file so the next run
+    # starts from there. Rows deleted from coveredentity are not detected incrementally;
+    # delete the file to rebuild the index from scratch.
+
+    # The first refresh of a persisted index also pulls rows whose lastUpdatedDate is
+    # past the high-water mark, looking back a little for writers whose clocks run
+    # behind. That picks up rows committed after a refresh that had already seen higher
+    # IDs (a range another run reserved earlier but inserted later).
+    refresh_overlap = timedelta(hours=1)
+
+    def __init__(self, schema_cache, path=None):
+        self.schema_cache = schema_cache
+        self.path = path
+        self.ids = {}
+        self.high_water_mark = None
+        self.max_id = None
+        self.loaded = False
+        # Whether this process has already caught up with the table by lastUpdatedDate
+        self.caught_up = False
+        self.dirty = {}
+        self.lock = threading.Lock()
+        if path and os.path.exists(path):
+            self._load_file()
+
+    def _connect_file(self):
+        index_db = sqlite3.connect(self.path)
+        index_db.execute("CREATE TABLE IF NOT EXISTS ids (id340B TEXT PRIMARY KEY, ID INTEGER NOT NULL)")
+        index_db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        return index_db
+
+    def _load_file(self):
+        index_db = self._connect_file()
+        try:
+            self.ids = dict(index_db.execute("SELECT id340B, ID FROM ids"))
+            row = index_db.execute("SELECT value FROM meta WHERE key = 'high_water_mark'").fetchone()
+            self.high_water_mark = datetime.fromisoformat(row[0]) if row and row[0] else None
+            self.max_id = max(self.ids.values(), default=None)
+            self.loaded = True
+            logger.info(f"Loaded {len(self.ids)} covered entity IDs from {self.path}")
+        finally:
+            index_db.close()
+
+    def save(self):
+        if not self.path:
+            return
+        with self.lock:
+            dirty = list(self.dirty.items())
+            high_water_mark = self.high_water_mark
+            self.dirty = {}
+        index_db = self._connect_file()
+        try:
+            with index_db:
+                index_db.executemany("INSERT OR REPLACE INTO ids (id340B, ID) VALUES (?, ?)", dirty)
+                index_db.execute(
+                    "INSERT OR REPLACE INTO meta (key, value) VALUES ('high_water_mark', ?)",
+                    (high_water_mark.isoformat() if high_water_mark else None,),
+                )
+        finally:
+            index_db.close()
+        logger.info(f"Saved {len(dirty)} changed covered entity IDs to {self.path}")
+
+    def refresh(self, connection):
+        # Returns the number of rows read from coveredentity
+        covered_entity_table = self.schema_cache.table('coveredentity')
+        query = select(covered_entity_table.c.ID, covered_entity_table.c.id340B, covered_entity_table.c.lastUpdatedDate)
+        with self.lock:
+            loaded = self.loaded
+            caught_up = self.caught_up
+            high_water_mark = self.high_water_mark
+            max_id = self.max_id
+        if loaded:
+            conditions = []
+            if max_id is not None:
+                conditions.append(covered_entity_table.c.ID > max_id)
+            if not caught_up and high_water_mark is not None:
+                conditions.append(covered_entity_table.c.lastUpdatedDate > high_water_mark - self.refresh_overlap)
+            if conditions:
+                query = query.where(or_(*conditions))
+
+        rows = connection.execute(query).fetchall()
+        changed = 0
+        with self.lock:
+            for row in rows:
+                if self.ids.get(row.id340B) != row.ID:
+                    self.ids[row.id340B] = row.ID
+                    self.dirty[row.id340B] = row.ID
+                    changed += 1
+                self._advance(row.ID, row.lastUpdatedDate)
+            self.loaded = True
+            self.caught_up = True
+        logger.info(f"Refreshed covered entity ID index ({len(rows)} read, {changed} changed, {len(self.ids)} total)")
+        return len(rows)
+
+    def update(self, pairs, last_updated=None):
+        # pairs of (id340B, ID) that were just inserted, stamped with last_updated. The
+        # high-water marks move past them so no later refresh reads them back.
+        with self.lock:
+            for id340B, covered_entity_id in pairs:
+                self.ids[id340B] = covered_entity_id
+                self.dirty[id340B] = covered_entity_id
+                self._advance(covered_entity_id, last_updated)
+
+    def _advance(self, covered_entity_id, last_updated):
+        if self.max_id is None or covered_entity_id > self.max_id:
+            self.max_id = covered_entity_id
+        if last_updated is not None and (self.high_water_mark is None or last_updated > self.high_water_mark):
+            self.high_water_mark = last_updated
+
+    def isin(self, id340B_series):
+        with self.lock:
+            return id340B_series.isin(self.ids.keys())
+
+    def map(self, id340B_series):
+        # Nullable integers, so IDs stay integers when some id340Bs aren't in the index
+        with self.lock:
+            return id340B_series.map(self.ids).astype('Int64')
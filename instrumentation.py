@@ -0,0 +1,209 @@
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+
+def peak_memory_bytes():
+    # High-water mark of the process's resident memory so far (None where it isn't available)
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if os.uname().sysname == 'Darwin' else peak * 1024
+
+
+def current_memory_bytes():
+    # Resident memory of the process right now (None where it isn't available). Unlike
+    # the high-water mark this goes down again, so it can be sampled during a step.
+    try:
+        with open('/proc/self/statm') as f:
+            resident_pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return resident_pages * os.sysconf('SC_PAGE_SIZE')
+
+
+def dataframe_bytes(df):
+    return int(df.memory_usage(deep=True).sum())
+
+
+class MemorySample:
+    # Resident memory when a measured call started, and the highest seen since
+    def __init__(self, start):
+        self.start = start
+        self.peak = start
+
+
+class RunMetrics:
+    # Timings, row counts and memory for every step of a run (Snowflake query, fetch and
+    # clean; SQL Server index refresh, dedup and inserts), grouped by the pipeline stage
+    # whose thread did the work. Each measured call is kept as a batch record and rolled
+    # up per step, and write_report() saves both as JSON so runs can be compared.
+    #
+    # A call's peak memory is the highest resident memory seen while it ran: a background
+    # thread samples it every memory_sample_interval seconds while any call is being
+    # measured, so memory a call allocates and frees again before it returns (e.g. the
+    # Arrow buffers behind fetch_pandas_all) still shows up. Stages run in parallel share
+    # the process, so a peak includes whatever other stages held at the time.
+    def __init__(self, memory_sample_interval=0.01):
+        self.started_at = datetime.now(timezone.utc)
+        self.started = time.perf_counter()
+        self.steps = {}
+        self.batches = []
+        self.pipeline_stats = {}
+        self.lock = threading.Lock()
+        self.current = threading.local()
+        self.memory_sample_interval = memory_sample_interval
+        # Measurements in progress, whose peaks the sampler keeps raising
+        self.active = set()
+        self.sampling = threading.Event()
+        self.sampler = None
+
+    @contextmanager
+    def stage(self, name):
+        # Attribute everything measured on this thread to the named stage
+        previous = getattr(self.current, 'stage', None)
+        self.current.stage = name
+        try:
+            yield
+        finally:
+            self.current.stage = previous
+
+    @contextmanager
+    def measure(self, step, rows=0, nbytes=0):
+        # Yields a dict the caller can update with the rows/bytes it ended up handling
+        measurement = {'rows': rows, 'bytes': nbytes}
+        memory = self._start_sampling()
+        started = time.perf_counter()
+        try:
+            yield measurement
+        finally:
+            seconds = time.perf_counter() - started
+            peak_memory, peak_growth = self._stop_sampling(memory)
+            self.record(step, seconds, measurement['rows'], measurement['bytes'], peak_memory, peak_growth)
+
+    def _start_sampling(self):
+        start = current_memory_bytes()
+        if start is None:
+            return None
+        memory = MemorySample(start)
+        with self.lock:
+            self.active.add(memory)
+            if self.sampler is None:
+                self.sampler = threading.Thread(target=self._sample, name='memory-sampler', daemon=True)
+                self.sampler.start()
+            self.sampling.set()
+        return memory
+
+    def _stop_sampling(self, memory):
+        # (peak resident memory during the call, how far that peak was above the start)
+        if memory is None:
+            return None, None
+        end = current_memory_bytes()
+        with self.lock:
+            self.active.discard(memory)
+            if not self.active:
+                self.sampling.clear()
+            peak = max(memory.peak, end or 0)
+        return peak, peak - memory.start
+
+    def _sample(self):
+        while True:
+            self.sampling.wait()
+            time.sleep(self.memory_sample_interval)
+            resident = current_memory_bytes()
+            with self.lock:
+                for memory in self.active:
+                    if resident > memory.peak:
+                        memory.peak = resident
+
+    def record(self, step, seconds, rows=0, nbytes=0, peak_memory=None, peak_growth=None):
+        stage = getattr(self.current, 'stage', None) or 'other'
+        with self.lock:
+            step_stats = self.steps.setdefault(stage, {}).setdefault(
+                step, {'calls': 0, 'rows': 0, 'bytes': 0, 'seconds': 0.0, 'peak_memory_bytes': None, 'peak_growth_bytes': None}
+            )
+            step_stats['calls'] += 1
+            step_stats['rows'] += rows
+            step_stats['bytes'] += nbytes
+            step_stats['seconds'] += seconds
+            if peak_memory is not None:
+                # The highest of any call: resident memory, and growth over the call's start
+                step_stats['peak_memory_bytes'] = max(step_stats['peak_memory_bytes'] or 0, peak_memory)
+                step_stats['peak_growth_bytes'] = max(step_stats['peak_growth_bytes'] or 0, peak_growth)
+            self.batches.append({
+                'stage': stage,
+                'step': step,
+                'rows': rows,
+                'bytes': nbytes,
+                'seconds': round(seconds, 6),
+                'peak_memory_bytes': peak_memory,
+                'peak_growth_bytes': peak_growth,
+            })
+
+    def record_pipeline(self, stats):
+        with self.lock:
+            self.pipeline_stats.update({name: dict(stage_stats) for name, stage_stats in stats.items()})
+
+    def report(self, **run_info):
+        with self.lock:
+            stages = {}
+            for stage in list(self.pipeline_stats) + [stage for stage in self.steps if stage not in self.pipeline_stats]:
+                steps = {
+                    step: dict(step_stats, rows_per_second=step_stats['rows'] / step_stats['seconds'] if step_stats['seconds'] else 0.0)
+                    for step, step_stats in self.steps.get(stage, {}).items()
+                }
+                stages[stage] = {'pipeline': self.pipeline_stats.get(stage), 'steps': steps}
+            batches = list(self.batches)
+        return {
+            'run': dict(
+                run_info,
+                started_at=self.started_at.isoformat(),
+                finished_at=datetime.now(timezone.utc).isoformat(),
+                seconds=time.perf_counter() - self.started,
+                peak_memory_bytes=peak_memory_bytes(),
+            ),
+            'stages': stages,
+            'batches': batches,
+        }
+
+    def write_report(self, path, **run_info):
+        report = self.report(**run_info)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(report, f, indent=2, default=str)
+        os.replace(temp_path, path)
+        logger.info(f"Wrote run report to {path}")
+        return report
+
+    def summary(self, report=None):
+        # Plain-text table of every stage's steps, for printing at the end of a run
+        report = report or self.report()
+        lines = [f"{'stage':<28} {'step':<14} {'calls':>7} {'rows':>10} {'seconds':>9} {'rows/sec':>10} {'MB':>9} {'peak MB':>9} {'+peak MB':>9}"]
+        for stage, stage_report in report['stages'].items():
+            for step, step_stats in stage_report['steps'].items():
+                peak_memory = step_stats['peak_memory_bytes'] or 0
+                peak_growth = step_stats['peak_growth_bytes'] or 0
+                lines.append(
+                    f"{stage:<28} {step:<14} {step_stats['calls']:>7} {step_stats['rows']:>10} "
+                    f"{step_stats['seconds']:>9.2f} {step_stats['rows_per_second']:>10.0f} "
+                    f"{step_stats['bytes'] / 2**20:>9.1f} {peak_memory / 2**20:>9.1f} {peak_growth / 2**20:>9.1f}"
+                )
+        run = report['run']
+        peak_memory = run['peak_memory_bytes']
+        lines.append(f"Total {run['seconds']:.1f}s, peak memory {peak_memory / 2**20 if peak_memory else 0:.0f} MB")
+        return '\n'.join(lines)
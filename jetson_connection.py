@@ -1,32 +1,259 @@
-from calendar import c
-from sqlalchemy import create_engine, MetaData, Table, insert, select, func
+from sqlalchemy import MetaData, Table, Column, select
 from sqlalchemy.exc import SQLAlchemyError
+import numpy as np
 import pandas as pd
-from datetime import datetime, timedelta, timezone
-from sqlalchemy.sql import text
+from datetime import datetime
 import logging
+import threading
+import time
+from contextlib import contextmanager
+from bulk_writer import ExecutemanyWriter, SQL_SERVER_MAX_PARAMETERS, dataframe_rows
+from schema_cache import SchemaCache
+from id_index import CoveredEntityIndex
+from instrumentation import RunMetrics
+from id_allocator import IdAllocator
+from checkpoint import BatchJournal, retry_transient
+from batch_sizing import BatchSizes
 logger = logging.getLogger(__name__)
 
+# Table each entity is loaded into and the key columns its rows are matched on there
+ENTITY_KEYS = {
+    'covered_entities': ('coveredentity', ['id340B']),
+    'covered_entity_identifiers': ('coveredentityidentifier', ['coveredEntityKeyId', 'identifier']),
+    'contract_pharmacies': ('contractpharmacy', ['id']),
+    'ce_parents': ('ceparentchild', ['CEKeyIDParent', 'CEKeyIDChild']),
+}
+
 
 class JetsonDatasource:
-    def __init__(self, sql_server_engine, jetson_user_id):
+    def __init__(self, sql_server_engine, jetson_user_id, writer=None, dedup='client', schema_cache=None, id_index=None, metrics=None,
+                 id_allocator=None, journal=None, batch_sizes=None):
         self.sql_server_engine = sql_server_engine
         self.jetson_user_id = jetson_user_id
+        # Each hrsa table is reflected once and shared by every method
+        self.schema_cache = schema_cache or SchemaCache(sql_server_engine)
+        # id340B -> coveredentity.ID, refreshed incrementally instead of re-read on every call
+        self.id_index = id_index or CoveredEntityIndex(self.schema_cache)
+        # Reserves ID ranges for coveredentity and coveredentityidentifier, whose IDs are assigned here
+        self.id_allocator = id_allocator or IdAllocator(sql_server_engine)
+        # Keys of every committed batch, so a resumed run can skip them
+        self.journal = journal or BatchJournal()
+        # Per-table batch sizes, tuned from measured insert throughput
+        self.batch_sizes = batch_sizes or BatchSizes()
+        self.writer = writer or ExecutemanyWriter()
+        # Writers that load through their own session can't see temp tables, so staging
+        # falls back to executemany on the caller's connection
+        self.staging_writer = self.writer if self.writer.session_bound else ExecutemanyWriter()
+        # 'client' pulls existing keys into Python to find duplicates; 'server' stages the
+        # batch in a temp table and lets SQL Server insert only the rows that are new
+        self.dedup = dedup
+        self.insert_counts = {}
+        self.insert_counts_lock = threading.Lock()
+        # Connection bound to the current thread's transfer stage by stage_connection()
+        self.stage_connections = threading.local()
+        self.connection_stats = {'checkouts': 0, 'seconds': 0.0, 'max_seconds': 0.0}
+        self.connection_stats_lock = threading.Lock()
+        # Connect, dedup and insert timings for the run report
+        self.metrics = metrics or RunMetrics()
 
-    def get_latest_covered_entity_id(self):
-        metadata = MetaData()
-        covered_entity_table = Table('coveredentity', metadata, autoload_with=self.sql_server_engine, schema='hrsa')
+    def checkout(self):
+        # Check a connection out of the engine's pool, timing how long it takes (a new
+        # Azure SQL login costs far more than handing out a pooled connection)
+        started = time.perf_counter()
+        connection = self.sql_server_engine.connect()
+        elapsed = time.perf_counter() - started
+        with self.connection_stats_lock:
+            self.connection_stats['checkouts'] += 1
+            self.connection_stats['seconds'] += elapsed
+            self.connection_stats['max_seconds'] = max(self.connection_stats['max_seconds'], elapsed)
+        self.metrics.record('connect', elapsed)
+        return connection
 
-        with self.sql_server_engine.connect() as connection:
-            stmt = select(func.max(covered_entity_table.c.ID))
-            result = connection.execute(stmt).scalar()
-            return result if result is not None else 0  # Return 0 if no records found
+    @contextmanager
+    def stage_connection(self):
+        # Bind one pooled connection to the calling thread for a whole transfer stage, so
+        # every insert_* call the stage makes reuses it instead of checking out its own.
+        # SQLAlchemy connections aren't thread-safe, so each stage thread gets its own.
+        connection = self.checkout()
+        self.stage_connections.connection = connection
+        try:
+            yield connection
+        finally:
+            self.stage_connections.connection = None
+            connection.close()
 
-    def insert_covered_entities(self, covered_entities_df):
-        latest_id = self.get_latest_covered_entity_id()
-        covered_entities_df['ID'] = covered_entities_df.index + 1
-        covered_entities_df['ID'] = covered_entities_df['ID'].apply(lambda x: latest_id + x)
+    @contextmanager
+    def connect(self):
+        connection = getattr(self.stage_connections, 'connection', None)
+        if connection is None:
+            with self.checkout() as connection:
+                yield connection
+            return
+        try:
+            yield connection
+        finally:
+            # Closing a connection would roll back whatever the call left uncommitted;
+            # do the same so the next call on this stage's connection starts clean
+            if connection.in_transaction():
+                connection.rollback()
+
+    def record_counts(self, table_name, inserted, skipped, unmapped=0):
+        # skipped rows are already in Jetsons; unmapped rows have no covered entity there
+        # yet, so they were not loaded and have to be extracted again by a later run
+        with self.insert_counts_lock:
+            counts = self.insert_counts.setdefault(table_name, {'inserted': 0, 'skipped': 0, 'unmapped': 0})
+            counts['inserted'] += inserted
+            counts['skipped'] += skipped
+            counts['unmapped'] += unmapped
+
+    def unmapped_rows(self, entity):
+        table_name = self.schema_cache.table(ENTITY_KEYS[entity][0]).fullname
+        with self.insert_counts_lock:
+            return self.insert_counts.get(table_name, {}).get('unmapped', 0)
+
+    def report_counts(self):
+        for table_name, counts in self.insert_counts.items():
+            unmapped = f", {counts['unmapped']} rows not loaded (no matching covered entity)" if counts['unmapped'] else ""
+            logger.info(f"{table_name}: {counts['inserted']} rows inserted, {counts['skipped']} rows skipped{unmapped}")
+
+    def report_connections(self):
+        stats = self.connection_stats
+        average = stats['seconds'] / stats['checkouts'] if stats['checkouts'] else 0.0
+        logger.info(
+            f"SQL Server connections: {stats['checkouts']} checkouts, {stats['seconds']:.2f}s acquiring "
+            f"(avg {average * 1000:.0f}ms, max {stats['max_seconds'] * 1000:.0f}ms); pool {self.sql_server_engine.pool.status()}"
+        )
+
+    def create_staging_table(self, connection, stage_name, stage_columns, source_table):
+        # Create an empty temp table whose columns (alias, source column) copy their types from source_table
+        connection.exec_driver_sql(f"IF OBJECT_ID('tempdb..{stage_name}') IS NOT NULL DROP TABLE {stage_name}")
+        column_list = ', '.join(f"{source} AS {alias}" for alias, source in stage_columns)
+        connection.exec_driver_sql(f"SELECT TOP 0 {column_list} INTO {stage_name} FROM {source_table.fullname}")
+        return Table(stage_name, MetaData(), *[Column(alias, source_table.c[source].type) for alias, source in stage_columns])
+
+    def load_staging_table(self, connection, stage_table, columns, rows):
+        batch_size = self.staging_writer.batch_size
+        for i in range(0, len(rows), batch_size):
+            with self.metrics.measure('stage', rows=len(rows[i:i+batch_size])):
+                self.staging_writer.write(connection, stage_table, columns, rows[i:i+batch_size])
+
+    def reserve_ids(self, table, id_column, count):
+        # First ID of a block of count IDs reserved for this caller alone
+        with self.metrics.measure('reserve_ids', rows=count):
+            return self.id_allocator.reserve(table, id_column, count)
+
+    def existing_keys(self, connection, table, key_columns, df):
+        # Look up which of the df's keys are already in the table, filtering on the first
+        # key column in chunks that stay under SQL Server's 2100-parameter limit
+        filter_column = key_columns[0]
+        values = df[filter_column].drop_duplicates().tolist()
+        existing = []
+        chunk_size = SQL_SERVER_MAX_PARAMETERS - 100
+        with self.metrics.measure('dedup', rows=len(df)):
+            for i in range(0, len(values), chunk_size):
+                query = select(*[table.c[column] for column in key_columns]).where(table.c[filter_column].in_(values[i:i+chunk_size]))
+                existing.extend(tuple(row) for row in connection.execute(query))
+        return pd.MultiIndex.from_tuples(existing, names=key_columns) if existing else pd.MultiIndex.from_arrays([[]] * len(key_columns), names=key_columns)
+
+    def merge_rows(self, connection, table, df, columns, key_columns, id_column=None):
+        # Server-side dedup for tables keyed by natural key columns: stage the rows, then
+        # insert the ones whose key isn't in the table yet. With id_column, the new rows
+        # are counted first and numbered from a block of IDs reserved for exactly that many.
+        stage_columns = [column for column in columns if column != id_column]
+        rows = dataframe_rows(df, stage_columns)
+        stage_name = f"#{table.name}_stage"
+        self.load_staging_table(
+            connection,
+            self.create_staging_table(connection, stage_name, [(column, column) for column in stage_columns], table),
+            stage_columns,
+            rows,
+        )
+
+        column_list = ', '.join(stage_columns)
+        staged_columns = ', '.join('s.' + column for column in stage_columns)
+        key_match = ' AND '.join(f"t.{column} = s.{column}" for column in key_columns)
+        new_rows = f"FROM {stage_name} s WHERE NOT EXISTS (SELECT 1 FROM {table.fullname} t WHERE {key_match})"
+        if id_column:
+            key_order = ', '.join('s.' + column for column in key_columns)
+            new_count = connection.exec_driver_sql(f"SELECT COUNT(*) {new_rows}").scalar()
+            first_id = self.reserve_ids(table, id_column, new_count) or 1
+            insert_statement = f"""
+                INSERT INTO {table.fullname} ({id_column}, {column_list})
+                SELECT {first_id - 1} + ROW_NUMBER() OVER (ORDER BY {key_order}), {staged_columns}
+            """
+        else:
+            insert_statement = f"""
+                INSERT INTO {table.fullname} ({column_list})
+                SELECT {staged_columns}
+            """
+        with self.metrics.measure('merge', rows=len(rows)):
+            inserted_count = connection.exec_driver_sql(f"""
+                SET NOCOUNT ON;
+                {insert_statement}
+                {new_rows};
+                SELECT @@ROWCOUNT;
+            """).scalar()
+        connection.exec_driver_sql(f"DROP TABLE {stage_name}")
+        connection.commit()
+
+        self.journal.record(table.fullname, df[key_columns].itertuples(index=False, name=None))
+        self.record_counts(table.fullname, inserted_count, len(rows) - inserted_count)
+        return inserted_count
+
+    def skip_committed(self, table, df, key_columns):
+        # On --resume, rows a failed earlier attempt already committed are dropped before any duplicate checks
+        remaining_df = self.journal.skip_committed(table.fullname, df, key_columns)
+        self.record_counts(table.fullname, 0, len(df) - len(remaining_df))
+        return remaining_df
+
+    def batch_committed(self, connection, table, columns, batch, key_columns):
+        # A batch commits as a whole, so if any of its keys made it in, all of them did
+        key_positions = [columns.index(column) for column in key_columns]
+        key_df = pd.DataFrame([[row[position] for position in key_positions] for row in batch], columns=key_columns)
+        existing = self.existing_keys(connection, table, key_columns, key_df)
+        return len(existing) > 0 and bool(pd.MultiIndex.from_frame(key_df).isin(existing).any())
+
+    def write_batch(self, connection, table, columns, batch, key_columns):
+        # Retried on transient errors. The connection can drop after the server has
+        # committed but before the client hears back, so a retry first checks whether
+        # the batch is already in the table instead of inserting it a second time.
+        # Returns how long the attempt that wrote the batch took, leaving out failed
+        # attempts and backoff, or None when it turned out to be committed already.
+        attempts = []
+
+        def write():
+            attempts.append(1)
+            if len(attempts) > 1 and self.batch_committed(connection, table, columns, batch, key_columns):
+                logger.info(f"Batch for {table.fullname} was committed before the error; not writing it again")
+                return None
+            started = time.perf_counter()
+            self.writer.write(connection, table, columns, batch)
+            connection.commit()
+            return time.perf_counter() - started
+
+        return retry_transient(write, f"insert into {table.fullname}", before_retry=connection.rollback)
+
+    def write_batches(self, connection, table, columns, rows, key_columns):
+        # Push rows (tuples ordered like columns) through the configured bulk writer,
+        # committing after every batch and journaling the key_columns of each one. Each
+        # batch's write time feeds the table's tuner, which picks the size of the next one.
+        tuner = self.batch_sizes.tuner(self.writer, table)
+        key_positions = [columns.index(column) for column in key_columns]
+        written = 0
+        while written < len(rows):
+            batch = rows[written:written + tuner.size]
+            with self.metrics.measure('insert', rows=len(batch)):
+                seconds = self.write_batch(connection, table, columns, batch, key_columns)
+            if seconds is not None:
+                tuner.observe(len(batch), seconds)
+            self.journal.record(table.fullname, [tuple(row[position] for position in key_positions) for row in batch])
+            written += len(batch)
+            logger.info(f"Inserted batch of {len(batch)} rows into {table.fullname} ({written} of {len(rows)})")
+        return len(rows)
 
+    def insert_covered_entities(self, covered_entities_df):
+        # IDs are only assigned to the rows that turn out to be new
+        covered_entities_df['ID'] = None
         covered_entities_df['grantNumber'] = None
         covered_entities_df['secondZip'] = None
         
@@ -34,51 +261,41 @@ class JetsonDatasource:
         current_datetime = datetime.now()
         covered_entities_df['lastUpdatedDate'] = current_datetime
         # Get the columns of the actual table
-        metadata = MetaData()
-        covered_entity_table = Table('coveredentity', metadata, autoload_with=self.sql_server_engine, schema='hrsa')
+        covered_entity_table = self.schema_cache.table('coveredentity')
 
         # Ensure DataFrame columns match the table columns
         table_columns = [column.name for column in covered_entity_table.columns]
         covered_entities_df = covered_entities_df[table_columns]
+        covered_entities_df = self.skip_committed(covered_entity_table, covered_entities_df, ['id340B'])
 
-        records = covered_entities_df.to_dict(orient='records')
+        if self.dedup == 'server':
+            return self.merge_covered_entities(covered_entities_df, covered_entity_table, table_columns)
 
-        with self.sql_server_engine.connect() as connection:
-            # Get existing primary keys from the table
-            existing_keys_query = select(covered_entity_table.c.id340B)
-            existing_keys_result = connection.execute(existing_keys_query)
-            existing_keys = {row[0] for row in existing_keys_result}
+        with self.connect() as connection:
+            # Bring the ID index up to date and use it to find keys that already exist
+            with self.metrics.measure('index_refresh') as measurement:
+                measurement['rows'] = self.id_index.refresh(connection)
+            with self.metrics.measure('dedup', rows=len(covered_entities_df)):
+                existing = self.id_index.isin(covered_entities_df['id340B'])
 
             # Separate records into new and duplicates
-            new_records = []
-            duplicate_records = []
-
-            for record in records:
-                key = record['id340B']
-                if key in existing_keys:
-                    duplicate_records.append(key)
-                else:
-                    new_records.append(record)
+            new_df = covered_entities_df[~existing].copy()
+            duplicate_records = covered_entities_df.loc[existing, 'id340B'].tolist()
             if duplicate_records:
                 print(f"The following keys already exist and were not inserted: {duplicate_records}")
+            self.record_counts(covered_entity_table.fullname, 0, len(duplicate_records))
             # Insert new records in batches
-            if new_records:
+            if not new_df.empty:
                 try:
-                    # Prepare the INSERT statement
-                    columns = ', '.join(table_columns)
-                    placeholders = ', '.join([':' + col for col in table_columns])
-                    insert_query = text(f"INSERT INTO hrsa.coveredentity ({columns}) VALUES ({placeholders})")
-                    
-                    # Insert records in smaller batches
-                    batch_size = 1000  # Adjust this value as needed
-                    for i in range(0, len(new_records), batch_size):
-                        batch = new_records[i:i+batch_size]
-                        connection.execute(insert_query, batch)
-                        connection.commit()
-                        print(f"Inserted batch {i//batch_size + 1} of {len(new_records)//batch_size + 1}")
+                    first_id = self.reserve_ids(covered_entity_table, 'ID', len(new_df))
+                    new_df['ID'] = np.arange(first_id, first_id + len(new_df))
+                    rows = dataframe_rows(new_df, table_columns)
+                    self.write_batches(connection, covered_entity_table, table_columns, rows, ['id340B'])
+                    self.record_counts(covered_entity_table.fullname, len(rows), 0)
+                    self.id_index.update(zip(new_df['id340B'].tolist(), new_df['ID'].tolist()), last_updated=current_datetime)
                     
-                    print(f"Successfully inserted {len(new_records)} records into the covered entity table.")
-                    return covered_entities_df
+                    print(f"Successfully inserted {len(new_df)} records into the covered entity table.")
+                    return new_df
                 except SQLAlchemyError as e:
                     error_message = str(e.orig)
                     print(f"An error occurred during insertion: {error_message}")
@@ -87,90 +304,196 @@ class JetsonDatasource:
                 print("No new records to insert.")
                 return covered_entities_df
 
+    def merge_covered_entities(self, covered_entities_df, covered_entity_table, table_columns):
+        stage_columns = [column for column in table_columns if column != 'ID']
+        rows = dataframe_rows(covered_entities_df, stage_columns)
+
+        with self.connect() as connection:
+            try:
+                def merge():
+                    self.load_staging_table(
+                        connection,
+                        self.create_staging_table(connection, '#coveredentity_stage', [(column, column) for column in stage_columns], covered_entity_table),
+                        stage_columns,
+                        rows,
+                    )
+
+                    # Only rows whose id340B isn't already in the table are inserted; they are
+                    # numbered from a block of IDs reserved for exactly that many rows
+                    new_rows = "FROM #coveredentity_stage s WHERE NOT EXISTS (SELECT 1 FROM hrsa.coveredentity t WHERE t.id340B = s.id340B)"
+                    new_count = connection.exec_driver_sql(f"SELECT COUNT(*) {new_rows}").scalar()
+                    first_id = self.reserve_ids(covered_entity_table, 'ID', new_count) or 1
+                    columns = ', '.join(stage_columns)
+                    staged_columns = ', '.join('s.' + column for column in stage_columns)
+                    with self.metrics.measure('merge', rows=len(rows)):
+                        inserted = connection.exec_driver_sql(f"""
+                            SET NOCOUNT ON;
+                            INSERT INTO hrsa.coveredentity (ID, {columns})
+                            OUTPUT INSERTED.ID, INSERTED.id340B
+                            SELECT {first_id - 1} + ROW_NUMBER() OVER (ORDER BY s.id340B), {staged_columns}
+                            {new_rows}
+                        """).fetchall()
+                    connection.exec_driver_sql("DROP TABLE #coveredentity_stage")
+                    connection.commit()
+                    return inserted
+
+                # The whole merge is retried: a dropped connection takes the temp table with it,
+                # and NOT EXISTS keeps a second attempt from inserting anything twice
+                inserted = retry_transient(merge, f"merge into {covered_entity_table.fullname}", before_retry=connection.rollback)
+            except SQLAlchemyError as e:
+                logger.error(f"An error occurred while merging covered entities: {e}")
+                return None
+
+        self.journal.record(covered_entity_table.fullname, covered_entities_df[['id340B']].itertuples(index=False, name=None))
+        self.record_counts(covered_entity_table.fullname, len(inserted), len(rows) - len(inserted))
+        self.id_index.update(((row.id340B, row.ID) for row in inserted), last_updated=covered_entities_df['lastUpdatedDate'].max())
+        logger.info(f"Inserted {len(inserted)} new covered entities, skipped {len(rows) - len(inserted)} existing ones")
+
+        # Return the rows that were inserted, with the IDs the server assigned them
+        inserted_ids = {row.id340B: row.ID for row in inserted}
+        covered_entities_df = covered_entities_df[covered_entities_df['id340B'].isin(inserted_ids)].copy()
+        covered_entities_df['ID'] = covered_entities_df['id340B'].map(inserted_ids)
+        return covered_entities_df
+
     def insert_covered_entity_identifiers(self, covered_entity_identifiers_df):
-        metadata = MetaData()
-        covered_entity_table = Table('coveredentity', metadata, autoload_with=self.sql_server_engine, schema='hrsa')
-        covered_entity_identifier_table = Table('coveredentityidentifier', metadata, autoload_with=self.sql_server_engine, schema='hrsa')
+        covered_entity_identifier_table = self.schema_cache.table('coveredentityidentifier')
 
-        with self.sql_server_engine.connect() as connection:
+        with self.connect() as connection:
             try:
                 # Get the associated covered entity id for each identifier
-                ce_id_query = select(covered_entity_table.c.ID, covered_entity_table.c.id340B)
-                ce_id_result = connection.execute(ce_id_query).fetchall()
-                ce_id_map = {row.id340B: row.ID for row in ce_id_result}
-                covered_entity_identifiers_df['coveredEntityKeyId'] = covered_entity_identifiers_df['id340B'].map(ce_id_map)
-                
-                # Get the latest covered entity identifier id
-                max_id_query = select(func.max(covered_entity_identifier_table.c.id))
-                max_id = connection.execute(max_id_query).scalar() or 0
-                covered_entity_identifiers_df['id'] = range(max_id + 1, max_id + 1 + len(covered_entity_identifiers_df))
+                with self.metrics.measure('index_refresh') as measurement:
+                    measurement['rows'] = self.id_index.refresh(connection)
+                covered_entity_identifiers_df['coveredEntityKeyId'] = self.id_index.map(covered_entity_identifiers_df['id340B'])
+
+                # Identifiers whose covered entity isn't in Jetsons yet can't be inserted
+                unmapped_count = len(covered_entity_identifiers_df)
+                covered_entity_identifiers_df = covered_entity_identifiers_df.dropna(subset=['coveredEntityKeyId']).copy()
+                unmapped_count -= len(covered_entity_identifiers_df)
+                if unmapped_count:
+                    logger.warning(f"Not loading {unmapped_count} covered entity identifiers with no matching covered entity")
+                self.record_counts(covered_entity_identifier_table.fullname, 0, 0, unmapped=unmapped_count)
 
                 # Add additional columns
                 current_datetime = datetime.now()
+                covered_entity_identifiers_df['id'] = None
                 covered_entity_identifiers_df['userCreated'] = False
                 covered_entity_identifiers_df['lastUpdatedDate'] = current_datetime
                 covered_entity_identifiers_df['activeFlag'] = True
-                records = covered_entity_identifiers_df.to_dict(orient='records')
 
-                # stmt = insert(covered_entity_identifier_table).values(records)
-                # connection.execute(stmt)
-                # connection.commit()
-                # print(f"Successfully inserted {len(records)} covered entity identifier records.")
+                table_columns = [column.name for column in covered_entity_identifier_table.columns
+                                 if column.name in covered_entity_identifiers_df.columns]
+                key_columns = ['coveredEntityKeyId', 'identifier']
+                covered_entity_identifiers_df = self.skip_committed(covered_entity_identifier_table, covered_entity_identifiers_df, key_columns)
+
+                if self.dedup == 'server':
+                    inserted_count = retry_transient(
+                        lambda: self.merge_rows(connection, covered_entity_identifier_table, covered_entity_identifiers_df,
+                                                table_columns, key_columns, id_column='id'),
+                        f"merge into {covered_entity_identifier_table.fullname}", before_retry=connection.rollback,
+                    )
+                    logger.info(f"Inserted {inserted_count} new covered entity identifiers, "
+                                f"skipped {len(covered_entity_identifiers_df) - inserted_count} existing ones")
+                    return covered_entity_identifiers_df
+
+                existing = self.existing_keys(connection, covered_entity_identifier_table, key_columns, covered_entity_identifiers_df)
+                is_duplicate = pd.MultiIndex.from_frame(covered_entity_identifiers_df[key_columns]).isin(existing)
+                new_df = covered_entity_identifiers_df[~is_duplicate].copy()
+                self.record_counts(covered_entity_identifier_table.fullname, 0, int(is_duplicate.sum()))
+
+                if new_df.empty:
+                    logger.info("No new covered entity identifiers to insert.")
+                    return covered_entity_identifiers_df
+
+                first_id = self.reserve_ids(covered_entity_identifier_table, 'id', len(new_df))
+                new_df['id'] = np.arange(first_id, first_id + len(new_df))
+
+                rows = dataframe_rows(new_df, table_columns)
+                self.write_batches(connection, covered_entity_identifier_table, table_columns, rows, key_columns)
+                self.record_counts(covered_entity_identifier_table.fullname, len(rows), 0)
+                logger.info(f"Successfully inserted {len(rows)} covered entity identifier records.")
+                return new_df
             except SQLAlchemyError as e:
-                print(f"An error occurred while inserting covered entity identifiers: {e}")
+                logger.error(f"An error occurred while inserting covered entity identifiers: {e}")
                 return None
 
+    def insert_contract_pharmacies(self, contract_pharmacies_df):
+        contract_pharmacy_table = self.schema_cache.table('contractpharmacy')
+
+        contract_pharmacies_df['lastUpdatedDate'] = datetime.now()
+        table_columns = [column.name for column in contract_pharmacy_table.columns
+                         if column.name in contract_pharmacies_df.columns]
+        contract_pharmacies_df = self.skip_committed(contract_pharmacy_table, contract_pharmacies_df, ['id'])
+
+        with self.connect() as connection:
+            try:
+                if self.dedup == 'server':
+                    inserted_count = retry_transient(
+                        lambda: self.merge_rows(connection, contract_pharmacy_table, contract_pharmacies_df, table_columns, ['id']),
+                        f"merge into {contract_pharmacy_table.fullname}", before_retry=connection.rollback,
+                    )
+                    logger.info(f"Inserted {inserted_count} new contract pharmacies, "
+                                f"skipped {len(contract_pharmacies_df) - inserted_count} existing ones")
+                    return contract_pharmacies_df
+
+                existing = self.existing_keys(connection, contract_pharmacy_table, ['id'], contract_pharmacies_df)
+                is_duplicate = pd.MultiIndex.from_frame(contract_pharmacies_df[['id']]).isin(existing)
+                new_df = contract_pharmacies_df[~is_duplicate]
+                self.record_counts(contract_pharmacy_table.fullname, 0, int(is_duplicate.sum()))
+
+                if new_df.empty:
+                    logger.info("No new contract pharmacies to insert.")
+                    return contract_pharmacies_df
+
+                rows = dataframe_rows(new_df, table_columns)
+                self.write_batches(connection, contract_pharmacy_table, table_columns, rows, ['id'])
+                self.record_counts(contract_pharmacy_table.fullname, len(rows), 0)
+                logger.info(f"Successfully inserted {len(rows)} contract pharmacy records.")
+                return new_df
+            except SQLAlchemyError as e:
+                logger.error(f"An error occurred while inserting contract pharmacies: {e}")
+                return None
 
     def insert_ce_parents(self, ce_parents_df):
-        metadata = MetaData()
-        ce_parent_table = Table('ceparentchild', metadata, autoload_with=self.sql_server_engine, schema='hrsa')
-        covered_entity_table = Table('coveredentity', metadata, autoload_with=self.sql_server_engine, schema='hrsa')
+        ce_parent_table = self.schema_cache.table('ceparentchild')
+        covered_entity_table = self.schema_cache.table('coveredentity')
 
-        with self.sql_server_engine.connect() as connection:
+        if self.dedup == 'server':
+            return self.merge_ce_parents(ce_parents_df, ce_parent_table, covered_entity_table)
+
+        with self.connect() as connection:
             try:
                 # Get the ID for the parent and child CEs if they exist in the coveredEntity table
-                ce_id_query = select(covered_entity_table.c.ID, covered_entity_table.c.id340B)
-                ce_id_result = connection.execute(ce_id_query).fetchall()
-                ce_id_map = {row.id340B: row.ID for row in ce_id_result}
-
-                ce_parents_df['CEKeyIDParent'] = ce_parents_df['parentId340B'].map(ce_id_map)
-                ce_parents_df['CEKeyIDChild'] = ce_parents_df['id340B'].map(ce_id_map)
+                with self.metrics.measure('index_refresh') as measurement:
+                    measurement['rows'] = self.id_index.refresh(connection)
+                ce_parents_df['CEKeyIDParent'] = self.id_index.map(ce_parents_df['parentId340B'])
+                ce_parents_df['CEKeyIDChild'] = self.id_index.map(ce_parents_df['id340B'])
 
                 # Filter out rows where either CEKeyIDParent or CEKeyIDChild is missing
+                unmapped_count = len(ce_parents_df)
                 ce_parents_df = ce_parents_df.dropna(subset=['CEKeyIDParent', 'CEKeyIDChild'])
+                unmapped_count -= len(ce_parents_df)
+                ce_parents_df = self.skip_committed(ce_parent_table, ce_parents_df, ['CEKeyIDParent', 'CEKeyIDChild'])
+
+                # Look up only this chunk's parents, then anti-join to find the new relationships
+                existing_relationships = self.existing_keys(connection, ce_parent_table, ['CEKeyIDParent', 'CEKeyIDChild'], ce_parents_df)
+                relationships = pd.MultiIndex.from_frame(ce_parents_df[['CEKeyIDParent', 'CEKeyIDChild']])
+                is_duplicate = relationships.isin(existing_relationships) if len(existing_relationships) else np.zeros(len(relationships), dtype=bool)
+                new_df = ce_parents_df[~is_duplicate]
+                duplicate_count = int(is_duplicate.sum())
+
+                if duplicate_count:
+                    logger.info(f"Found {duplicate_count} duplicate CE parent-child relationships (not inserted)")
+                if unmapped_count:
+                    logger.warning(f"Not loading {unmapped_count} CE parent-child relationships with no matching covered entity")
+                self.record_counts(ce_parent_table.fullname, 0, duplicate_count, unmapped=unmapped_count)
 
-                # Get existing parent-child relationships
-                existing_relationships_query = select(ce_parent_table.c.CEKeyIDParent, ce_parent_table.c.CEKeyIDChild)
-                existing_relationships_result = connection.execute(existing_relationships_query)
-                existing_relationships = set((row.CEKeyIDParent, row.CEKeyIDChild) for row in existing_relationships_result)
-
-                # Prepare records for insertion, excluding duplicates
-                new_records = []
-                duplicate_records = []
-                for _, row in ce_parents_df.iterrows():
-                    relationship = (row['CEKeyIDParent'], row['CEKeyIDChild'])
-                    if relationship not in existing_relationships:
-                        new_records.append(relationship)
-                    else:
-                        duplicate_records.append(relationship)
-
-                if duplicate_records:
-                    logger.info(f"Found {len(duplicate_records)} duplicate CE parent-child relationships (not inserted)")
-
-                if new_records:
+                if not new_df.empty:
                     try:
-                        # Prepare the INSERT statement
-                        insert_query = text("INSERT INTO hrsa.ceparentchild (CEKeyIDParent, CEKeyIDChild) VALUES (:CEKeyIDParent, :CEKeyIDChild)")
+                        rows = dataframe_rows(new_df, ['CEKeyIDParent', 'CEKeyIDChild'])
+                        self.write_batches(connection, ce_parent_table, ['CEKeyIDParent', 'CEKeyIDChild'], rows, ['CEKeyIDParent', 'CEKeyIDChild'])
+                        self.record_counts(ce_parent_table.fullname, len(rows), 0)
                         
-                        # Insert records in smaller batches
-                        batch_size = 1000  # Adjust this value as needed
-                        for i in range(0, len(new_records), batch_size):
-                            batch = [{'CEKeyIDParent': parent, 'CEKeyIDChild': child} for parent, child in new_records[i:i+batch_size]]
-                            connection.execute(insert_query, batch)
-                            connection.commit()
-                            logger.info(f"Inserted batch {i//batch_size + 1} of {len(new_records)//batch_size + 1}")
-                        
-                        logger.info(f"Successfully inserted {len(new_records)} new records into the ce parent table.")
+                        logger.info(f"Successfully inserted {len(rows)} new records into the ce parent table.")
                         return ce_parents_df
                     except SQLAlchemyError as e:
                         error_message = str(e.orig)
@@ -183,3 +506,87 @@ class JetsonDatasource:
             except SQLAlchemyError as e:
                 logger.error(f"An error occurred while preparing ce parents data: {e}")
                 return None
+
+    def merge_ce_parents(self, ce_parents_df, ce_parent_table, covered_entity_table):
+        ce_parents_df = self.skip_committed(ce_parent_table, ce_parents_df, ['parentId340B', 'id340B'])
+        rows = dataframe_rows(ce_parents_df, ['parentId340B', 'id340B'])
+
+        with self.connect() as connection:
+            try:
+                def merge():
+                    self.load_staging_table(
+                        connection,
+                        self.create_staging_table(connection, '#ceparentchild_stage', [('parentId340B', 'id340B'), ('id340B', 'id340B')], covered_entity_table),
+                        ['parentId340B', 'id340B'],
+                        rows,
+                    )
+
+                    # Relationships with a side that isn't in coveredentity yet can't be inserted
+                    unmapped = connection.exec_driver_sql("""
+                        SELECT s.parentId340B, s.id340B
+                        FROM #ceparentchild_stage s
+                        WHERE NOT EXISTS (SELECT 1 FROM hrsa.coveredentity parent WHERE parent.id340B = s.parentId340B)
+                        OR NOT EXISTS (SELECT 1 FROM hrsa.coveredentity child WHERE child.id340B = s.id340B)
+                    """).fetchall()
+
+                    # Resolve both sides to covered entity IDs on the server and insert only the
+                    # relationships that don't exist yet
+                    with self.metrics.measure('merge', rows=len(rows)):
+                        inserted_count = connection.exec_driver_sql("""
+                            INSERT INTO hrsa.ceparentchild (CEKeyIDParent, CEKeyIDChild)
+                            SELECT DISTINCT parent.ID, child.ID
+                            FROM #ceparentchild_stage s
+                            JOIN hrsa.coveredentity parent ON parent.id340B = s.parentId340B
+                            JOIN hrsa.coveredentity child ON child.id340B = s.id340B
+                            WHERE NOT EXISTS (
+                                SELECT 1 FROM hrsa.ceparentchild t
+                                WHERE t.CEKeyIDParent = parent.ID AND t.CEKeyIDChild = child.ID
+                            )
+                        """).rowcount
+                    connection.exec_driver_sql("DROP TABLE #ceparentchild_stage")
+                    connection.commit()
+                    return inserted_count, {tuple(row) for row in unmapped}
+
+                inserted_count, unmapped = retry_transient(merge, f"merge into {ce_parent_table.fullname}", before_retry=connection.rollback)
+            except SQLAlchemyError as e:
+                logger.error(f"An error occurred while merging ce parents: {e}")
+                return None
+
+        # Unmapped rows weren't loaded, so a resumed run mustn't skip them
+        mapped_rows = [row for row in rows if tuple(row) not in unmapped]
+        self.journal.record(ce_parent_table.fullname, mapped_rows)
+        skipped_count = len(mapped_rows) - inserted_count
+        self.record_counts(ce_parent_table.fullname, inserted_count, skipped_count, unmapped=len(rows) - len(mapped_rows))
+        if len(rows) > len(mapped_rows):
+            logger.warning(f"Not loading {len(rows) - len(mapped_rows)} CE parent-child relationships with no matching covered entity")
+        logger.info(f"Inserted {inserted_count} new CE parent-child relationships, skipped {skipped_count}")
+        return ce_parents_df
+
+    def compare(self, entity, df):
+        # Dry run of a load: count how many extracted rows are already in Jetsons and how
+        # many would be inserted, without writing anything. Rows whose covered entity
+        # isn't in Jetsons yet (e.g. one this run would insert first) can't be matched.
+        table_name, key_columns = ENTITY_KEYS[entity]
+        table = self.schema_cache.table(table_name)
+
+        with self.connect() as connection:
+            try:
+                if entity in ('covered_entity_identifiers', 'ce_parents'):
+                    with self.metrics.measure('index_refresh') as measurement:
+                        measurement['rows'] = self.id_index.refresh(connection)
+                if entity == 'covered_entity_identifiers':
+                    df['coveredEntityKeyId'] = self.id_index.map(df['id340B'])
+                elif entity == 'ce_parents':
+                    df['CEKeyIDParent'] = self.id_index.map(df['parentId340B'])
+                    df['CEKeyIDChild'] = self.id_index.map(df['id340B'])
+                matched_df = df.dropna(subset=key_columns)
+
+                existing = self.existing_keys(connection, table, key_columns, matched_df)
+                existing_count = int(pd.MultiIndex.from_frame(matched_df[key_columns]).isin(existing).sum()) if len(existing) else 0
+            except SQLAlchemyError as e:
+                logger.error(f"An error occurred while comparing {entity} with {table.fullname}: {e}")
+                return None
+
+        logger.info(f"Dry run: {len(matched_df) - existing_count} of {len(df)} {entity} rows would be inserted into {table.fullname} "
+                    f"({existing_count} already exist, {len(df) - len(matched_df)} can't be matched to a covered entity)")
+        return df
@@ -4,8 +4,18 @@ import argparse
 from dotenv import load_dotenv
 from snowflake.connector import connect as snowflake_connect
 from sqlalchemy import create_engine
-from snowflake_connection import SnowflakeDatasource
+from snowflake_connection import SnowflakeDatasource, DEFAULT_CHUNK_SIZE
 from jetson_connection import JetsonDatasource
+from pipeline import TransferPipeline
+from sync_state import SyncState
+from bulk_writer import WRITERS, create_writer
+from schema_cache import SchemaCache
+from id_index import CoveredEntityIndex
+from instrumentation import RunMetrics
+from checkpoint import BatchJournal
+from batch_sizing import BatchSizes
+from extract_cache import ExtractCache, ExtractCacheMiss
+from datetime import datetime
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -45,59 +55,269 @@ def create_snowflake_engine():
         logger.error(f"Failed to create Snowflake connection: {str(e)}")
         raise
 
-def create_sql_server_engine():
+def sql_server_pool_options():
+    # Pool settings can be tuned per environment file. Every new Azure SQL login (TDS +
+    # TLS) is expensive, so connections are kept, checked with a ping before reuse and
+    # recycled before the server's idle timeout drops them.
+    return {
+        'pool_size': int(os.getenv('SQL_SERVER_POOL_SIZE', 5)),
+        'max_overflow': int(os.getenv('SQL_SERVER_MAX_OVERFLOW', 10)),
+        'pool_timeout': int(os.getenv('SQL_SERVER_POOL_TIMEOUT', 30)),
+        'pool_recycle': int(os.getenv('SQL_SERVER_POOL_RECYCLE', 1800)),
+        'pool_pre_ping': os.getenv('SQL_SERVER_POOL_PRE_PING', 'true').lower() in ('1', 'true', 'yes'),
+    }
+
+def create_sql_server_engine(fast_executemany=False):
     try:
         connection_string = (
             f"mssql+pyodbc://{os.getenv('JETSONS_USERNAME')}:{os.getenv('JETSONS_PASSWORD')}@"
             f"{os.getenv('KWEB_SERVER')}/{os.getenv('KWEB_DATABASE')}?driver=ODBC+Driver+17+for+SQL+Server"
         )
-        sql_server_engine = create_engine(connection_string)
-        logger.info("SQL Server engine created successfully")
+        # fast_executemany makes pyodbc send each executemany batch as one parameter array
+        pool_options = sql_server_pool_options()
+        sql_server_engine = create_engine(connection_string, fast_executemany=fast_executemany, **pool_options)
+        logger.info(f"SQL Server engine created successfully ({', '.join(f'{k}={v}' for k, v in pool_options.items())})")
         return sql_server_engine
     except Exception as e:
         logger.error(f"Failed to create SQL Server engine: {str(e)}")
         raise
 
-def main(env):
+# Stage name, entity (SnowflakeDatasource get_/stream_ suffix and sync watermark), the
+# JetsonDatasource method that loads it, and the stages whose load has to finish first
+TRANSFER_STAGES = [
+    ("covered entities", 'covered_entities', 'insert_covered_entities', []),
+    # CE parents and identifiers need covered entity IDs, so they are extracted while covered
+    # entities are still being inserted but only loaded once every covered entity is written
+    ("CE parents", 'ce_parents', 'insert_ce_parents', ["covered entities"]),
+    ("covered entity identifiers", 'covered_entity_identifiers', 'insert_covered_entity_identifiers', ["covered entities"]),
+    ("contract pharmacies", 'contract_pharmacies', 'insert_contract_pharmacies', []),
+]
+ENTITIES = [entity for _, entity, _, _ in TRANSFER_STAGES]
+
+def extract(snowflake_datasource_factory, entity, stream, chunk_size, missing_extracts):
+    # Each stage extracts over its own Snowflake connection, opened on its producer thread
+    def run():
+        snowflake_datasource = snowflake_datasource_factory()
+        try:
+            if stream:
+                yield from getattr(snowflake_datasource, f"stream_{entity}")(chunk_size)
+            else:
+                yield getattr(snowflake_datasource, f"get_{entity}")()
+        except ExtractCacheMiss as e:
+            # With --load-only an entity with nothing cached is skipped rather than
+            # aborting the other stages; transfer() leaves its watermark where it was
+            logger.warning(f"Skipping {entity}: {e}")
+            missing_extracts.add(entity)
+        finally:
+            snowflake_datasource.close()
+    return run
+
+def dry_run_load(jetson_datasource, entity):
+    return lambda df: jetson_datasource.compare(entity, df)
+
+def transfer(snowflake_datasource_factory, jetson_datasource, entities=None, stream=False, chunk_size=DEFAULT_CHUNK_SIZE,
+             queue_size=2, max_workers=None, sync_state=None, metrics=None, dry_run=False, extract_cache=None):
+    entities = entities or ENTITIES
+    pipeline = TransferPipeline(queue_size=queue_size, max_workers=max_workers, metrics=metrics)
+    stage_entities = {}
+    stage_dependencies = {}
+    missing_extracts = set()
+    for name, entity, insert, after in TRANSFER_STAGES:
+        if entity not in entities:
+            continue
+        # A dry run compares each extract with Jetsons instead of loading it
+        load = dry_run_load(jetson_datasource, entity) if dry_run else getattr(jetson_datasource, insert)
+        missing_dependencies = [dependency for dependency in after if dependency not in pipeline.stages]
+        if missing_dependencies:
+            # Rows whose covered entity isn't in Jetsons yet will be left out, and the
+            # entity's watermark isn't advanced (see below)
+            logger.warning(f"Transferring {name} without {', '.join(missing_dependencies)}: rows whose covered entity "
+                           f"isn't in Jetsons yet won't be loaded, and {name} won't be marked as synced")
+        pipeline.add_stage(name, extract(snowflake_datasource_factory, entity, stream, chunk_size, missing_extracts), load,
+                           after=[dependency for dependency in after if dependency in pipeline.stages],
+                           session=jetson_datasource.stage_connection)
+        stage_entities[name] = entity
+        stage_dependencies[name] = after
+    stats = pipeline.run()
+
+    # Stages are checked in TRANSFER_STAGES order, so a stage's dependencies come first
+    complete = set()
+    for name, stage_stats in stats.items():
+        logger.info(
+            f"Transferred {stage_stats['rows']} {name} in {stage_stats['chunks']} chunks "
+            f"({stage_stats['failed_chunks']} failed, extract {stage_stats['extract_seconds']:.1f}s, "
+            f"load {stage_stats['load_seconds']:.1f}s)"
+        )
+        entity = stage_entities[name]
+        stage_stats['extract_missing'] = entity in missing_extracts
+        if dry_run:
+            continue
+        # Only move an entity's watermark forward once all of its rows were loaded: it was
+        # extracted, no chunk failed, no row was left out for lack of a covered entity, and
+        # every stage it depends on was part of this run and complete too (otherwise its
+        # rows may have been left out)
+        incomplete_dependencies = [dependency for dependency in stage_dependencies[name] if dependency not in complete]
+        unmapped_rows = jetson_datasource.unmapped_rows(entity)
+        if stage_stats['extract_missing']:
+            logger.warning(f"Not advancing the {entity} watermark: no cached extract was loaded")
+            continue
+        if stage_stats['failed_chunks'] or unmapped_rows or incomplete_dependencies:
+            logger.warning(
+                f"Not advancing the {entity} watermark: {stage_stats['failed_chunks']} failed chunks, "
+                f"{unmapped_rows} rows not loaded, incomplete dependencies {incomplete_dependencies or 'none'}"
+            )
+            continue
+        complete.add(name)
+        if sync_state is not None:
+            sync_state.commit(entity)
+        # Nothing is left to replay, so the next run extracts this entity afresh
+        if extract_cache is not None:
+            extract_cache.invalidate(entity)
+    return stats
+
+def main(env, options=None):
+    options = options or build_parser().parse_args([])
+    metrics = RunMetrics()
+    status = 'failed'
+    journal = None
     try:
         load_environment_variables(env)
         
-        snowflake_conn = create_snowflake_engine()
-        sql_server_engine = create_sql_server_engine()
+        sql_server_engine = create_sql_server_engine(fast_executemany=(options.writer == 'fast_executemany'))
+        bulk_writer = create_writer(options.writer)
+        logger.info(f"Using the {bulk_writer.name} bulk writer")
+
+        sync_state = SyncState(options.sync_state, full_refresh=options.full_refresh)
+        # A dry run writes no batches, so it leaves the journal of a run to be resumed alone
+        journal = BatchJournal(None if options.dry_run else options.journal, resume=options.resume)
+        batch_sizes = BatchSizes(options.batch_sizes, adaptive=not options.fixed_batch_size)
+        extract_cache = ExtractCache(options.extract_cache, ttl=options.extract_cache_ttl,
+                                     max_bytes=options.extract_cache_size * 1024 ** 2, refresh=options.refresh_extracts)
 
-        snowflake_datasource = SnowflakeDatasource(snowflake_conn, os.getenv('SNOWFLAKE_DATABASE'))
-        jetson_datasource = JetsonDatasource(sql_server_engine, os.getenv('JETSONS_USER_ID'))
+        def snowflake_datasource_factory():
+            # Snowflake is only connected to for extracts that aren't in the cache, and never with --load-only
+            return SnowflakeDatasource(None, os.getenv('SNOWFLAKE_DATABASE'), sync_state=sync_state, metrics=metrics,
+                                       extract_cache=extract_cache, connect=None if options.load_only else create_snowflake_engine)
+
+        schema_cache = SchemaCache(sql_server_engine, schema='hrsa', path=options.schema_cache, ttl=options.schema_cache_ttl)
+        jetson_datasource = JetsonDatasource(sql_server_engine, os.getenv('JETSONS_USER_ID'), writer=bulk_writer, dedup=options.dedup,
+                                             schema_cache=schema_cache, id_index=CoveredEntityIndex(schema_cache, path=options.id_index),
+                                             metrics=metrics, journal=journal, batch_sizes=batch_sizes)
+
+        # Each stage holds one pooled connection while it loads, plus short checkouts for
+        # schema reflection; beyond what the pool can hand out, stages wait on pool_timeout
+        pool_options = sql_server_pool_options()
+        concurrent_loads = min(options.workers or len(options.entities), len(options.entities))
+        if concurrent_loads >= pool_options['pool_size'] + pool_options['max_overflow']:
+            logger.warning(f"{concurrent_loads} concurrent loads may exhaust the SQL Server pool "
+                           f"(pool_size={pool_options['pool_size']}, max_overflow={pool_options['max_overflow']})")
 
         logger.info(f"Starting data transfer process in {env} environment")
+        if options.full_refresh:
+            logger.info("Full refresh requested; ignoring stored watermarks")
+        if options.dry_run:
+            logger.info("Dry run: comparing extracts with Jetsons without writing to it")
+        if options.load_only:
+            logger.info(f"Load only: reading extracts from {options.extract_cache} without querying Snowflake")
 
-        # Covered Entities
-        covered_entities_df = snowflake_datasource.get_covered_entities()
-        logger.info(f"Retrieved {len(covered_entities_df)} covered entities from Snowflake")
-        result = jetson_datasource.insert_covered_entities(covered_entities_df)
-        if result is not None:
-            logger.info("Covered entities inserted successfully")
-        else:
-            logger.warning("No covered entities were inserted")
-
-        # CE Parents
-        ce_parents_df = snowflake_datasource.get_ce_parents()
-        logger.info(f"Retrieved {len(ce_parents_df)} CE parents from Snowflake")
-        result = jetson_datasource.insert_ce_parents(ce_parents_df)
-        if result is not None:
-            logger.info("CE parents inserted successfully")
-        else:
-            logger.warning("No CE parents were inserted")
+        stats = transfer(snowflake_datasource_factory, jetson_datasource, entities=options.entities, stream=options.stream,
+                         chunk_size=options.chunk_size, queue_size=options.queue_size, max_workers=options.workers,
+                         sync_state=sync_state, metrics=metrics, dry_run=options.dry_run,
+                         extract_cache=extract_cache)
 
-        logger.info("Data transfer process completed successfully")
+        jetson_datasource.id_index.save()
+        batch_sizes.save()
+        bulk_writer.report()
+        batch_sizes.report()
+        jetson_datasource.report_counts()
+        jetson_datasource.report_connections()
+        failed_chunks = sum(stage_stats['failed_chunks'] for stage_stats in stats.values())
+        missing_extracts = [name for name, stage_stats in stats.items() if stage_stats['extract_missing']]
+        if failed_chunks:
+            logger.warning(f"{failed_chunks} chunks were not inserted; rerun with --resume to skip the batches that were")
+            status = 'partial'
+        elif missing_extracts:
+            logger.warning(f"No fresh cached extract for {', '.join(missing_extracts)}; rerun without --load-only to extract them")
+            status = 'partial'
+        elif options.dry_run:
+            status = 'dry_run'
+            logger.info("Dry run completed; nothing was written to Jetsons")
+        else:
+            # Everything is committed, so there is nothing left to resume
+            journal.clear()
+            status = 'succeeded'
+            logger.info("Data transfer process completed successfully")
 
     except Exception as e:
         logger.error(f"An error occurred during the data transfer process: {str(e)}")
         raise
+    finally:
+        if journal is not None:
+            journal.close()
+        # Written for failed runs too, so a slow or broken night can be compared with the last good one
+        report_path = options.run_report or os.path.join('run_reports', f"run_{datetime.now():%Y%m%d_%H%M%S}.json")
+        report = metrics.write_report(report_path, env=env, status=status, writer=options.writer, dedup=options.dedup,
+                                      stream=options.stream, entities=options.entities, dry_run=options.dry_run,
+                                      load_only=options.load_only)
+        if options.summary:
+            print(metrics.summary(report))
 
-if __name__ == "__main__":
+def build_parser():
     parser = argparse.ArgumentParser(description="Run the data transfer process with specified environment.")
     parser.add_argument('--env', choices=['test', 'production'], default='test',
                         help="Specify the environment to use (test or production)")
-    args = parser.parse_args()
+    parser.add_argument('--entities', nargs='+', choices=ENTITIES, default=ENTITIES,
+                        help="Entities to transfer; independent entities are transferred in parallel")
+    parser.add_argument('--workers', type=int, default=None,
+                        help="Maximum number of entities loading into SQL Server at the same time (default: no limit)")
+    parser.add_argument('--run-report', default=None,
+                        help="Path of the JSON run report (default: run_reports/run_<timestamp>.json)")
+    parser.add_argument('--summary', action='store_true',
+                        help="Print a per-stage timing summary table at the end of the run")
+    parser.add_argument('--stream', action='store_true',
+                        help="Stream results from Snowflake in chunks instead of loading each result set into memory")
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of rows per chunk when streaming")
+    parser.add_argument('--queue-size', type=int, default=2,
+                        help="Maximum number of chunks buffered between each Snowflake fetch and its SQL Server writer")
+    parser.add_argument('--writer', choices=list(WRITERS), default='executemany',
+                        help="Strategy used to bulk-load rows into SQL Server")
+    parser.add_argument('--batch-sizes', default='.batch_sizes.json',
+                        help="JSON file the tuned batch size of each table is saved to and started from on the next run")
+    parser.add_argument('--fixed-batch-size', action='store_true',
+                        help="Always use the writer's default batch size instead of tuning it from measured throughput")
+    parser.add_argument('--dedup', choices=['client', 'server'], default='client',
+                        help="Find existing rows in Python (client) or with a staging table and set-based insert on SQL Server (server)")
+    parser.add_argument('--schema-cache', default=None,
+                        help="Optional JSON file where reflected hrsa table columns are kept between runs")
+    parser.add_argument('--schema-cache-ttl', type=int, default=24 * 60 * 60,
+                        help="Seconds before a persisted table schema is reflected again")
+    parser.add_argument('--id-index', default=None,
+                        help="Optional SQLite file where the id340B to covered entity ID map is kept between runs")
+    parser.add_argument('--sync-state', default='.sync_state.json',
+                        help="JSON file holding the per-entity watermarks of the last successful sync")
+    parser.add_argument('--journal', default='.batch_journal.sqlite',
+                        help="SQLite file recording the keys of every committed batch, for --resume")
+    parser.add_argument('--resume', action='store_true',
+                        help="Skip rows that the journal shows a failed earlier run already committed")
+    parser.add_argument('--full-refresh', action='store_true',
+                        help="Ignore stored watermarks and extract everything that is missing from Jetsons")
+    parser.add_argument('--extract-cache', default='.extract_cache',
+                        help="Directory where cleaned extracts are cached as Arrow files for re-runs, dry runs and --load-only")
+    parser.add_argument('--extract-cache-ttl', type=int, default=4 * 60 * 60,
+                        help="Seconds a cached extract is reused for before Snowflake is queried again")
+    parser.add_argument('--extract-cache-size', type=int, default=2048,
+                        help="Megabytes of cached extracts to keep; the oldest are evicted beyond this")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="Extract and compare with Jetsons, logging how many rows would be inserted, without writing anything")
+    extract_source = parser.add_mutually_exclusive_group()
+    extract_source.add_argument('--load-only', action='store_true',
+                                help="Load only from cached extracts and never query Snowflake; entities with no fresh cached extract are skipped")
+    extract_source.add_argument('--refresh-extracts', action='store_true',
+                                help="Query Snowflake even when a fresh cached extract exists (the cache is still updated)")
+    return parser
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
     
-    main(args.env)
+    main(args.env, args)
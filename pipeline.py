@@ -0,0 +1,153 @@
+import logging
+import queue
+import threading
+import time
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+def _put(buffer, item, stop):
+    # Block while the queue is full (back-pressure) but give up once the pipeline is aborting
+    while not stop.is_set():
+        try:
+            buffer.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _get(buffer, stop):
+    while not stop.is_set():
+        try:
+            return buffer.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return _DONE
+
+
+class Stage:
+    def __init__(self, name, extract, load, after=(), session=None):
+        self.name = name
+        self.extract = extract
+        self.load = load
+        self.after = tuple(after)
+        self.session = session
+        self.buffer = None
+        self.loaded = threading.Event()
+        self.stats = {'chunks': 0, 'rows': 0, 'failed_chunks': 0, 'extract_seconds': 0.0, 'load_seconds': 0.0}
+
+
+class TransferPipeline:
+    # Runs every stage's extract on its own producer thread and its load on its own
+    # consumer thread, connected by a bounded queue. A stage's load only starts once
+    # the loads of the stages listed in `after` have finished, but its extract starts
+    # straight away, so Snowflake fetches overlap with SQL Server writes. Stages that
+    # don't depend on each other load in parallel, at most max_workers at a time.
+    def __init__(self, queue_size=2, max_workers=None, metrics=None):
+        self.queue_size = queue_size
+        # Optional RunMetrics; both threads of a stage attribute what they measure to it
+        self.metrics = metrics
+        self.load_slots = threading.BoundedSemaphore(max_workers) if max_workers else None
+        self.stages = {}
+        self.abort = threading.Event()
+        self.errors = []
+        self.errors_lock = threading.Lock()
+
+    def add_stage(self, name, extract, load, after=(), session=None):
+        # session: optional context manager factory entered on the load thread around the
+        # whole load, e.g. to hold one database connection for all of the stage's chunks
+        for dependency in after:
+            if dependency not in self.stages:
+                raise ValueError(f"Stage {name} depends on unknown stage {dependency}")
+        self.stages[name] = Stage(name, extract, load, after, session)
+        return self.stages[name]
+
+    def _fail(self, stage, error):
+        with self.errors_lock:
+            self.errors.append((stage.name, error))
+        logger.error(f"Stage {stage.name} failed: {error}")
+        self.abort.set()
+
+    def _stage_metrics(self, stage):
+        return self.metrics.stage(stage.name) if self.metrics is not None else nullcontext()
+
+    def _produce(self, stage):
+        with self._stage_metrics(stage):
+            self._extract(stage)
+
+    def _extract(self, stage):
+        try:
+            started = time.perf_counter()
+            for chunk in stage.extract():
+                stage.stats['extract_seconds'] += time.perf_counter() - started
+                if not _put(stage.buffer, chunk, self.abort):
+                    return
+                started = time.perf_counter()
+            _put(stage.buffer, _DONE, self.abort)
+        except BaseException as e:
+            self._fail(stage, e)
+
+    def _consume(self, stage):
+        with self._stage_metrics(stage):
+            self._wait_and_load(stage)
+
+    def _wait_and_load(self, stage):
+        try:
+            for dependency in stage.after:
+                while not self.stages[dependency].loaded.wait(timeout=0.1):
+                    if self.abort.is_set():
+                        return
+            if self.load_slots is not None:
+                while not self.load_slots.acquire(timeout=0.1):
+                    if self.abort.is_set():
+                        return
+            try:
+                if stage.session is not None:
+                    with stage.session():
+                        self._load(stage)
+                else:
+                    self._load(stage)
+            finally:
+                if self.load_slots is not None:
+                    self.load_slots.release()
+            if not self.abort.is_set():
+                stage.loaded.set()
+        except BaseException as e:
+            self._fail(stage, e)
+
+    def _load(self, stage):
+        while True:
+            chunk = _get(stage.buffer, self.abort)
+            if chunk is _DONE:
+                break
+            stage.stats['chunks'] += 1
+            stage.stats['rows'] += len(chunk)
+            logger.info(f"Loading chunk {stage.stats['chunks']} with {len(chunk)} {stage.name}")
+            started = time.perf_counter()
+            result = stage.load(chunk)
+            stage.stats['load_seconds'] += time.perf_counter() - started
+            if result is None:
+                stage.stats['failed_chunks'] += 1
+                logger.warning(f"Chunk {stage.stats['chunks']} of {stage.name} was not inserted")
+
+    def run(self):
+        threads = []
+        for stage in self.stages.values():
+            stage.buffer = queue.Queue(maxsize=self.queue_size)
+            threads.append(threading.Thread(target=self._produce, args=(stage,), name=f"extract-{stage.name}", daemon=True))
+            threads.append(threading.Thread(target=self._consume, args=(stage,), name=f"load-{stage.name}", daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        if self.metrics is not None:
+            self.metrics.record_pipeline({name: stage.stats for name, stage in self.stages.items()})
+        if self.errors:
+            # Re-raise the first failure in the calling thread
+            raise self.errors[0][1]
+        return {name: stage.stats for name, stage in self.stages.items()}
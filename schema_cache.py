@@ -0,0 +1,133 @@
+import json
+import logging
+import os
+import threading
+import time
+from sqlalchemy import MetaData, Table, Column
+from sqlalchemy.sql import text
+from sqlalchemy.types import UserDefinedType
+
+logger = logging.getLogger(__name__)
+
+
+class PersistedType(UserDefinedType):
+    # Column type restored from the schema cache file; it compiles back to the exact
+    # type string SQL Server reported when the table was reflected
+    cache_ok = True
+
+    def __init__(self, type_string):
+        self.type_string = type_string
+
+    def get_col_spec(self, **kw):
+        return self.type_string
+
+
+class SchemaCache:
+    # Reflects each table once per process and shares the result between every
+    # JetsonDatasource call. With a path, the reflected columns are also written to a
+    # local JSON file and reused by later runs until they are older than ttl seconds
+    # or, when validate is set, until the schema's last modification date changes.
+    def __init__(self, engine, schema='hrsa', path=None, ttl=24 * 60 * 60, validate=True):
+        self.engine = engine
+        self.schema = schema
+        self.path = path
+        self.ttl = ttl
+        self.validate = validate
+        self.metadata = MetaData()
+        self.tables = {}
+        self.lock = threading.Lock()
+        self.persisted = self._load_file()
+        self.schema_version = None
+        self.schema_version_checked = False
+
+    def _load_file(self):
+        if not self.path or not os.path.exists(self.path):
+            return {'schema_version': None, 'tables': {}}
+        try:
+            with open(self.path) as f:
+                persisted = json.load(f)
+            if persisted.get('schema') != self.schema:
+                return {'schema_version': None, 'tables': {}}
+            return persisted
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable schema cache {self.path}: {e}")
+            return {'schema_version': None, 'tables': {}}
+
+    def _save_file(self):
+        if not self.path:
+            return
+        self.persisted['schema'] = self.schema
+        self.persisted['schema_version'] = self.schema_version
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.persisted, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def _current_schema_version(self):
+        # One cheap catalog query instead of a full reflection: ALTER TABLE bumps modify_date
+        if self.engine.dialect.name != 'mssql':
+            return None
+        with self.engine.connect() as connection:
+            version = connection.execute(text("""
+                SELECT MAX(t.modify_date)
+                FROM sys.tables t
+                JOIN sys.schemas s ON s.schema_id = t.schema_id
+                WHERE s.name = :schema
+            """), {'schema': self.schema}).scalar()
+        return version.isoformat() if version is not None else None
+
+    def _persisted_columns(self, name):
+        entry = self.persisted['tables'].get(name)
+        if entry is None:
+            return None
+        if self.ttl is not None and time.time() - entry['reflected_at'] > self.ttl:
+            return None
+        if self.validate:
+            if not self.schema_version_checked:
+                self.schema_version = self._current_schema_version()
+                self.schema_version_checked = True
+            if self.schema_version != self.persisted.get('schema_version'):
+                return None
+        return entry['columns']
+
+    def _reflect(self, name):
+        table = Table(name, self.metadata, autoload_with=self.engine, schema=self.schema)
+        if self.path:
+            if self.validate and not self.schema_version_checked:
+                self.schema_version = self._current_schema_version()
+                self.schema_version_checked = True
+            if self.persisted.get('schema_version') != self.schema_version:
+                # Everything persisted under the old schema version is stale now
+                self.persisted['tables'] = {}
+            self.persisted['tables'][name] = {
+                'reflected_at': time.time(),
+                'columns': [
+                    {
+                        'name': column.name,
+                        'type': column.type.compile(dialect=self.engine.dialect),
+                        'nullable': column.nullable,
+                        'primary_key': column.primary_key,
+                    }
+                    for column in table.columns
+                ],
+            }
+            self._save_file()
+        return table
+
+    def table(self, name):
+        with self.lock:
+            if name not in self.tables:
+                columns = self._persisted_columns(name)
+                if columns is not None:
+                    logger.info(f"Using cached schema for {self.schema}.{name}")
+                    self.tables[name] = Table(
+                        name, self.metadata,
+                        *[Column(column['name'], PersistedType(column['type']),
+                                 nullable=column['nullable'], primary_key=column['primary_key'])
+                          for column in columns],
+                        schema=self.schema,
+                    )
+                else:
+                    logger.info(f"Reflecting {self.schema}.{name}")
+                    self.tables[name] = self._reflect(name)
+            return self.tables[name]
@@ -1,10 +1,92 @@
 from xml.etree.ElementTree import QName
+import logging
 import pandas
+from datetime import datetime, timezone
+from decimal import Decimal
+from instrumentation import RunMetrics, dataframe_bytes
+from extract_cache import ExtractCacheMiss, cached_frames
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 50000
+
+# Column each extract is windowed on for incremental syncs: the mart it is read from,
+# the column, and the alias the column is referenced by in the extract query. Only
+# entities windowed on their own key are listed. Identifiers and CE parents have no key,
+# load timestamp or hash of their own in the marts, and a new identifier or parent link
+# can belong to an old covered entity. They are extracted in full every run, and the
+# anti-join against Jetsons keeps that to the rows that are missing.
+WATERMARKS = {
+    'covered_entities': ('mart_covered_entities', 'covered_entity_key_id', 'r66'),
+    'contract_pharmacies': ('mart_contract_pharmacies', 'contract_pharmacy_key_id', 'r66'),
+}
+
+# Dtypes each cleaned extract is converted to. Low-cardinality fields are categorical,
+# identifiers and free text are Arrow-backed strings, and IDs are nullable integers so
+# a missing ID doesn't turn the whole column into floats.
+CATEGORY = 'category'
+STRING = 'string[pyarrow]'
+ID = 'Int64'
+ENTITY_SCHEMAS = {
+    'covered_entities': {
+        'id340B': STRING,
+        'zip': STRING,
+        'city': CATEGORY,
+        'medicareProviderNumber': STRING,
+        'address2': STRING,
+        'address1': STRING,
+        'entityType': CATEGORY,
+        'entitySubDivisionName': STRING,
+        'st': CATEGORY,
+        'entityName': STRING,
+    },
+    'covered_entity_identifiers': {
+        'identifierType': CATEGORY,
+        'identifier': STRING,
+        'id340B': STRING,
+    },
+    'contract_pharmacies': {
+        'id': ID,
+        'HRSAPHARMACYNAME': STRING,
+        'HRSAADDRESS1': STRING,
+        'city': CATEGORY,
+        'st': CATEGORY,
+        'zip': STRING,
+        'secondZip': STRING,
+        'ncpdp': STRING,
+    },
+    'ce_parents': {
+        'id340B': STRING,
+        'parentId340B': STRING,
+        'CEKeyIDChild': ID,
+    },
+}
+
+
+def apply_schema(df, schema):
+    # Drop the columns the schema doesn't list and convert the rest in place, one column
+    # at a time, so only one column is ever copied at once
+    df.drop(columns=[column for column in df.columns if column not in schema], inplace=True)
+    for column, dtype in schema.items():
+        if df[column].dtype != dtype:
+            df[column] = df[column].astype(dtype)
+    if list(df.columns) != list(schema):
+        df = df[list(schema)]
+    return df
+
 
 class SnowflakeDatasource:
-    def __init__(self, snowflake_conn, snowflake_database):
+    def __init__(self, snowflake_conn, snowflake_database, sync_state=None, metrics=None, extract_cache=None, connect=None):
+        # With a connect callable instead of a connection, Snowflake is only connected to
+        # once an extract isn't found in extract_cache; with neither, only cached extracts
+        # can be read
         self.snowflake_conn = snowflake_conn
+        self.connect = connect
         self.snowflake_database = snowflake_database
+        self.sync_state = sync_state
+        self.extract_cache = extract_cache
+        # Query, fetch and clean timings for the run report
+        self.metrics = metrics or RunMetrics()
 
     def clean_covered_entities(self, covered_entities_df):
         # Convert to lowercase
@@ -25,11 +107,9 @@ class SnowflakeDatasource:
         } 
 
         # Rename columns
-        covered_entities_df = covered_entities_df.rename(columns=column_mapping)
-        # Select only the columns that are being remapped
-        columns_to_keep = list(column_mapping.values())
-        covered_entities_df = covered_entities_df[columns_to_keep]
-        return covered_entities_df
+        covered_entities_df.rename(columns=column_mapping, inplace=True)
+        # Keep only the remapped columns, with their typed dtypes
+        return apply_schema(covered_entities_df, ENTITY_SCHEMAS['covered_entities'])
 
     def clean_covered_entity_identifiers(self, covered_entity_identifiers_df):
         # Convert to lowercase
@@ -43,19 +123,20 @@ class SnowflakeDatasource:
         }
 
         # Rename columns
-        covered_entity_identifiers_df = covered_entity_identifiers_df.rename(columns=column_mapping)
+        covered_entity_identifiers_df.rename(columns=column_mapping, inplace=True)
         
-        # Select only the columns that are being remapped
-        columns_to_keep = list(column_mapping.values()) 
-        covered_entity_identifiers_df = covered_entity_identifiers_df[columns_to_keep]
-        return covered_entity_identifiers_df
+        # Keep only the remapped columns, with their typed dtypes
+        return apply_schema(covered_entity_identifiers_df, ENTITY_SCHEMAS['covered_entity_identifiers'])
     
     def clean_contract_pharmacies(self, contract_pharmacies_df):
+        # Convert to lowercase
+        contract_pharmacies_df.columns = contract_pharmacies_df.columns.str.lower()
+
         # Define column mapping
         column_mapping = {
             'value': 'id',
-            'PHARMACY_NAME': 'HRSAPHARMACYNAME',
-            'ADDRESS_STREET_1': 'HRSAADDRESS1',
+            'pharmacy_name': 'HRSAPHARMACYNAME',
+            'address_street_1': 'HRSAADDRESS1',
             'address_city': 'city',
             'address_state': 'st',
             'address_zip': 'zip',
@@ -64,12 +145,10 @@ class SnowflakeDatasource:
         }
 
         # Rename columns
-        contract_pharmacies_df = contract_pharmacies_df.rename(columns=column_mapping)
+        contract_pharmacies_df.rename(columns=column_mapping, inplace=True)
         
-        # Select only the columns that are being remapped
-        columns_to_keep = list(column_mapping.values()) 
-        contract_pharmacies_df = contract_pharmacies_df[columns_to_keep]
-        return contract_pharmacies_df
+        # Keep only the remapped columns, with their typed dtypes
+        return apply_schema(contract_pharmacies_df, ENTITY_SCHEMAS['contract_pharmacies'])
 
     def clean_ce_parents(self, ce_parents_df):
         # Convert to lowercase
@@ -83,29 +162,67 @@ class SnowflakeDatasource:
         }
 
         # Rename columns
-        ce_parents_df = ce_parents_df.rename(columns=column_mapping)
-        return ce_parents_df
+        ce_parents_df.rename(columns=column_mapping, inplace=True)
+        return apply_schema(ce_parents_df, ENTITY_SCHEMAS['ce_parents'])
     
 
     # ------------------------------
 
-    def get_covered_entities(self):
-        covered_entities_query = f"""
+    def cursor(self):
+        if self.snowflake_conn is None:
+            if self.connect is None:
+                raise ExtractCacheMiss("No fresh cached extract to load and no Snowflake connection to extract with")
+            self.snowflake_conn = self.connect()
+        return self.snowflake_conn.cursor()
+
+    def close(self):
+        if self.snowflake_conn is not None:
+            self.snowflake_conn.close()
+            self.snowflake_conn = None
+
+    def current_watermark(self, entity):
+        mart, column, _ = WATERMARKS[entity]
+        snowflake_cursor = self.cursor()
+        with self.metrics.measure('watermark'):
+            snowflake_cursor.execute(f"select max({column}) from {self.snowflake_database}.silver.{mart}")
+            watermark = snowflake_cursor.fetchone()[0]
+        # NUMBER columns come back as Decimal; keep integral keys as ints so they round-trip through JSON
+        if isinstance(watermark, Decimal) and watermark == watermark.to_integral_value():
+            watermark = int(watermark)
+        return watermark
+
+    def windowed(self, entity):
+        return self.sync_state is not None and entity in WATERMARKS
+
+    def watermark_filter(self, entity):
+        # Restrict an extract to rows past the entity's last successful sync, up to the
+        # maximum at the start of this run. Returns the predicate and its parameters; the
+        # upper bound is only looked up (with_upper_bound) when the query is actually run.
+        if not self.windowed(entity):
+            return "", {}
+        _, column, alias = WATERMARKS[entity]
+        predicate = f"and {alias}.{column} <= %(watermark_to)s"
+        params = {}
+        lower_bound = self.sync_state.lower_bound(entity)
+        if lower_bound is not None:
+            predicate += f" and {alias}.{column} > %(watermark_from)s"
+            params['watermark_from'] = lower_bound
+        return predicate, params
+
+    def covered_entities_query(self):
+        watermark_filter, params = self.watermark_filter('covered_entities')
+        return f"""
             select r66.*
             from {self.snowflake_database}.silver.mart_covered_entities r66
             left join fivetran_database.kalderos_web_hrsa.coveredentity kprod
                 on kprod.id  = r66.covered_entity_key_id
             where kprod.id is null
-        """
+            {watermark_filter}
+        """, params
 
-        snowflake_cursor = self.snowflake_conn.cursor()
-        snowflake_cursor.execute(covered_entities_query)
-        snowflake_df = snowflake_cursor.fetch_pandas_all()
-        snowflake_df = self.clean_covered_entities(snowflake_df)
-        return snowflake_df
-    
-    def get_covered_entity_identifiers(self):
-        covered_entity_identifiers_query = f"""
+    def covered_entity_identifiers_query(self):
+        watermark_filter, params = self.watermark_filter('covered_entity_identifiers')
+        return f"""
             select r66.*
             from {self.snowflake_database}.silver.mart_covered_entities_identifier_crosswalk as r66
             inner join {self.snowflake_database}.silver.mart_covered_entities as ce_mart
@@ -115,43 +232,195 @@ class SnowflakeDatasource:
                 and kprod.identifier = r66.crosswalked_identifier_field_value
             where kprod.coveredentitykeyid is null
             and r66.identifier_field_name != 'medicaid_number'
-        """
-
-        snowflake_cursor = self.snowflake_conn.cursor()
-        snowflake_cursor.execute(covered_entity_identifiers_query)
-        snowflake_df = snowflake_cursor.fetch_pandas_all()
-        snowflake_df = self.clean_covered_entity_identifiers(snowflake_df)
-        return snowflake_df
-    
+            {watermark_filter}
+        """, params
 
-    def get_contract_pharmacies(self):
-        contract_pharmacies_query = f"""
+    def contract_pharmacies_query(self):
+        watermark_filter, params = self.watermark_filter('contract_pharmacies')
+        return f"""
             SELECT r66.*
             FROM {self.snowflake_database}.silver.mart_contract_pharmacies r66
             LEFT JOIN fivetran_database.kalderos_web_hrsa.contractpharmacy kprod
                 ON kprod.id = r66.contract_pharmacy_key_id
-            WHERE kprod.id IS NULL;
-        """
+            WHERE kprod.id IS NULL
+            {watermark_filter}
+        """, params
 
-        snowflake_cursor = self.snowflake_conn.cursor()
-        snowflake_cursor.execute(contract_pharmacies_query)
-        snowflake_df = snowflake_cursor.fetch_pandas_all()
-        snowflake_df = self.clean_contract_pharmacies(snowflake_df)
-        return snowflake_df
-    
-    def get_ce_parents(self):
-        ce_parents_query = f"""
+    def ce_parents_query(self):
+        watermark_filter, params = self.watermark_filter('ce_parents')
+        return f"""
             select r66.ce_340b_id, r66.parent_ce_340b_id, r66.covered_entity_key_id
             from {self.snowflake_database}.silver.mart_covered_entities as r66
             left join fivetran_database.kalderos_web_hrsa.ceparentchild as kprod_pce
                 on kprod_pce.cekeyidparent = r66.covered_entity_key_id
             where kprod_pce.id is null
             and source ='springfield'
-        """
+            {watermark_filter}
+        """, params
 
-        snowflake_cursor = self.snowflake_conn.cursor()
-        snowflake_cursor.execute(ce_parents_query)
-        snowflake_df = snowflake_cursor.fetch_pandas_all()
-        snowflake_df = self.clean_ce_parents(snowflake_df)
+    def with_upper_bound(self, entity, params):
+        if not self.windowed(entity):
+            return params
+        return dict(params, watermark_to=self.sync_state.upper_bound(entity, lambda: self.current_watermark(entity)))
+
+    def cached_extract(self, entity, query, params):
+        # The cache key of the query and, when the cache holds a fresh copy of its result,
+        # that copy. A hit replays the watermark window the copy was extracted with.
+        if self.extract_cache is None:
+            return None, None
+        key = self.extract_cache.key(entity, self.snowflake_database, query, params)
+        cached = self.extract_cache.get(key)
+        if cached is None:
+            return key, None
+        cached_table, metadata = cached
+        if self.windowed(entity):
+            watermark_to = metadata.get('watermark_to')
+            # A window already fixed by an earlier extract in this run wins over the cached one
+            if self.sync_state.upper_bound(entity, lambda: watermark_to) != watermark_to:
+                return key, None
+        logger.info(f"Reading {cached_table.num_rows} {entity} rows from the extract cache (extracted {metadata.get('extracted_at')})")
+        return key, cached_table
+
+    def cache_writer(self, key, entity, params):
+        if key is None:
+            return None
+        return self.extract_cache.writer(key, {
+            'entity': entity,
+            'watermark_to': params.get('watermark_to'),
+            'extracted_at': datetime.now(timezone.utc).isoformat(),
+        })
+
+    def timed_cache_reads(self, entity, frames):
+        frames = iter(frames)
+        while True:
+            with self.metrics.measure('cache_read') as measurement:
+                cached_df = next(frames, None)
+                if cached_df is not None:
+                    # The cache stores plain columns; restore the typed dtypes the cleaners give
+                    cached_df = apply_schema(cached_df, ENTITY_SCHEMAS[entity])
+                    measurement['rows'] = len(cached_df)
+                    measurement['bytes'] = dataframe_bytes(cached_df)
+            if cached_df is None:
+                return
+            yield cached_df
+
+    def timed_clean(self, clean, snowflake_df):
+        # The clean step's bytes are the cleaned frame's footprint, next to the fetch
+        # step's bytes for the frame as it came from Snowflake
+        with self.metrics.measure('clean', rows=len(snowflake_df)) as measurement:
+            snowflake_df = clean(snowflake_df)
+            measurement['bytes'] = dataframe_bytes(snowflake_df)
+        return snowflake_df, measurement['bytes']
+
+    def fetch_all(self, entity, query, params, clean):
+        key, cached_table = self.cached_extract(entity, query, params)
+        if cached_table is not None:
+            return next(self.timed_cache_reads(entity, cached_frames(cached_table)))
+
+        params = self.with_upper_bound(entity, params)
+        snowflake_cursor = self.cursor()
+        with self.metrics.measure('query'):
+            snowflake_cursor.execute(query, params or None)
+        with self.metrics.measure('fetch') as measurement:
+            snowflake_df = snowflake_cursor.fetch_pandas_all()
+            measurement['rows'] = len(snowflake_df)
+            measurement['bytes'] = dataframe_bytes(snowflake_df)
+        fetched_bytes = measurement['bytes']
+        snowflake_df, cleaned_bytes = self.timed_clean(clean, snowflake_df)
+        logger.info(f"Cleaned {len(snowflake_df)} {entity} rows: {fetched_bytes / 2**20:.1f} MB as fetched, "
+                    f"{cleaned_bytes / 2**20:.1f} MB with typed columns")
+
+        cache_writer = self.cache_writer(key, entity, params)
+        if cache_writer is not None:
+            with self.metrics.measure('cache_write', rows=len(snowflake_df)):
+                cache_writer.write(snowflake_df)
+                cache_writer.close()
         return snowflake_df
- 
\ No newline at end of file
+
+    def fetch_batches(self, entity, query, params, clean, chunk_size=DEFAULT_CHUNK_SIZE):
+        # Stream the result set in chunks of at most chunk_size rows so memory stays
+        # bounded by the chunk size rather than by the size of the whole result set
+        key, cached_table = self.cached_extract(entity, query, params)
+        if cached_table is not None:
+            yield from self.timed_cache_reads(entity, cached_frames(cached_table, chunk_size))
+            return
+
+        params = self.with_upper_bound(entity, params)
+        snowflake_cursor = self.cursor()
+        with self.metrics.measure('query'):
+            snowflake_cursor.execute(query, params or None)
+        # Chunks are appended to the cache entry as they stream; it is only kept if the
+        # whole result set was read
+        cache_writer = self.cache_writer(key, entity, params)
+        completed = False
+        try:
+            for snowflake_df in rechunk(self.timed_batches(snowflake_cursor.fetch_pandas_batches()), chunk_size):
+                snowflake_df, _ = self.timed_clean(clean, snowflake_df)
+                if cache_writer is not None:
+                    with self.metrics.measure('cache_write', rows=len(snowflake_df)):
+                        cache_writer.write(snowflake_df)
+                yield snowflake_df
+            completed = True
+        finally:
+            if cache_writer is not None:
+                if completed:
+                    cache_writer.close()
+                else:
+                    cache_writer.discard()
+
+    def timed_batches(self, batches):
+        # Time each batch as it is fetched, apart from the time the caller then spends on it
+        batches = iter(batches)
+        while True:
+            with self.metrics.measure('fetch') as measurement:
+                batch_df = next(batches, None)
+                if batch_df is not None:
+                    measurement['rows'] = len(batch_df)
+                    measurement['bytes'] = dataframe_bytes(batch_df)
+            if batch_df is None:
+                return
+            yield batch_df
+
+    def get_covered_entities(self):
+        return self.fetch_all('covered_entities', *self.covered_entities_query(), self.clean_covered_entities)
+
+    def get_covered_entity_identifiers(self):
+        return self.fetch_all('covered_entity_identifiers', *self.covered_entity_identifiers_query(), self.clean_covered_entity_identifiers)
+
+    def get_contract_pharmacies(self):
+        return self.fetch_all('contract_pharmacies', *self.contract_pharmacies_query(), self.clean_contract_pharmacies)
+
+    def get_ce_parents(self):
+        return self.fetch_all('ce_parents', *self.ce_parents_query(), self.clean_ce_parents)
+
+    def stream_covered_entities(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        return self.fetch_batches('covered_entities', *self.covered_entities_query(), self.clean_covered_entities, chunk_size)
+
+    def stream_covered_entity_identifiers(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        return self.fetch_batches('covered_entity_identifiers', *self.covered_entity_identifiers_query(), self.clean_covered_entity_identifiers, chunk_size)
+
+    def stream_contract_pharmacies(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        return self.fetch_batches('contract_pharmacies', *self.contract_pharmacies_query(), self.clean_contract_pharmacies, chunk_size)
+
+    def stream_ce_parents(self, chunk_size=DEFAULT_CHUNK_SIZE):
+        return self.fetch_batches('ce_parents', *self.ce_parents_query(), self.clean_ce_parents, chunk_size)
+
+
+def rechunk(batches, chunk_size):
+    # fetch_pandas_batches yields whatever chunk sizes Snowflake's result set was split
+    # into, so regroup them into frames of exactly chunk_size rows (the last may be shorter)
+    pending = []
+    pending_rows = 0
+    for batch_df in batches:
+        if batch_df.empty:
+            continue
+        pending.append(batch_df)
+        pending_rows += len(batch_df)
+        while pending_rows >= chunk_size:
+            combined_df = pandas.concat(pending, ignore_index=True) if len(pending) > 1 else pending[0].reset_index(drop=True)
+            yield combined_df.iloc[:chunk_size].reset_index(drop=True)
+            remainder_df = combined_df.iloc[chunk_size:]
+            pending = [remainder_df] if not remainder_df.empty else []
+            pending_rows = len(remainder_df)
+    if pending:
+        yield pandas.concat(pending, ignore_index=True)
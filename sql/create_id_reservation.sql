@@ -0,0 +1,10 @@
+-- Reservation table for IdAllocator (id_allocator.py): the next free ID of each table
+-- whose IDs the transfer assigns. Run once per Jetsons database by someone with DDL
+-- rights; the transfer login only needs SELECT, INSERT and UPDATE on it.
+IF OBJECT_ID('hrsa.id_reservation', 'U') IS NULL
+BEGIN
+    CREATE TABLE hrsa.id_reservation (
+        table_name VARCHAR(256) NOT NULL PRIMARY KEY,
+        next_id BIGINT NOT NULL
+    );
+END;
@@ -0,0 +1,59 @@
+import json
+import logging
+import os
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+
+class SyncState:
+    # Per-entity high-water marks for incremental extraction, kept in a local JSON file.
+    # A run stages the watermark it extracts up to and only commits it once that
+    # entity has been loaded successfully, so a failed run is retried from the same
+    # starting point. With full_refresh the stored watermarks are ignored for the
+    # extract but still replaced by the new ones on success.
+    def __init__(self, path, full_refresh=False):
+        self.path = path
+        self.full_refresh = full_refresh
+        self.state = self._load_file()
+        self.pending = {}
+        self.lock = threading.Lock()
+
+    def _load_file(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def _save_file(self):
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, 'w') as f:
+            json.dump(self.state, f, indent=2, default=str)
+        os.replace(temp_path, self.path)
+
+    def lower_bound(self, entity):
+        if self.full_refresh:
+            return None
+        with self.lock:
+            return self.state.get(entity, {}).get('watermark')
+
+    def upper_bound(self, entity, current_watermark):
+        # The first extract of an entity in a run fixes its upper bound, so every later
+        # query for it (e.g. a streamed retry) sees the same window
+        with self.lock:
+            if entity not in self.pending:
+                self.pending[entity] = current_watermark()
+            return self.pending[entity]
+
+    def commit(self, entity):
+        with self.lock:
+            watermark = self.pending.pop(entity, None)
+            if watermark is None:
+                return
+            self.state[entity] = {
+                'watermark': watermark,
+                'synced_at': datetime.now(timezone.utc).isoformat(),
+            }
+            self._save_file()
+        logger.info(f"Recorded {entity} watermark {watermark}")
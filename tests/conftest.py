@@ -0,0 +1,32 @@
+import os
+import sys
+
+import pytest
+from sqlalchemy import create_engine, event
+
+# The modules live at the top of the repository rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.stand_ins import create_hrsa_engine
+
+
+@pytest.fixture
+def engine(tmp_path):
+    # SQLite with a second database attached as the hrsa schema, so tables are addressed
+    # the same way as on SQL Server
+    engine = create_engine(f"sqlite:///{tmp_path / 'main.db'}")
+
+    @event.listens_for(engine, 'connect')
+    def attach_hrsa(dbapi_connection, connection_record):
+        dbapi_connection.execute(f"ATTACH DATABASE '{tmp_path / 'hrsa.db'}' AS hrsa")
+
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def jetsons_engine(tmp_path):
+    # The same, with the hrsa tables the transfer writes to already created
+    engine = create_hrsa_engine(str(tmp_path))
+    yield engine
+    engine.dispose()
@@ -0,0 +1,139 @@
+import json
+import time
+from types import SimpleNamespace
+
+import pytest
+from sqlalchemy.exc import DBAPIError
+
+import checkpoint
+from batch_sizing import BatchSizes, BatchSizeTuner
+from bulk_writer import ExecutemanyWriter
+from jetson_connection import JetsonDatasource
+
+
+def throughput(size, best=8000):
+    # rows/sec rising toward best and falling off past it
+    return 50000 * min(size / best, best / size)
+
+
+def tune(tuner, batches=50):
+    sizes = []
+    for _ in range(batches):
+        if tuner.settled:
+            break
+        sizes.append(tuner.size)
+        tuner.observe(tuner.size, tuner.size / throughput(tuner.size))
+    return sizes
+
+
+def test_tuner_climbs_toward_the_best_throughput_and_settles():
+    tuner = BatchSizeTuner('executemany:hrsa.coveredentity', 1000, 100, 100000)
+
+    sizes = tune(tuner)
+
+    assert tuner.settled
+    assert sizes[:4] == [1000, 2000, 4000, 8000]
+    assert tuner.size == 8000
+    # Once settled, faster or slower batches (within max_seconds) don't move it
+    tuner.observe(tuner.size, 1.0)
+    tuner.observe(tuner.size, 0.01)
+    assert tuner.size == 8000
+
+
+def test_tuner_ignores_short_batches():
+    tuner = BatchSizeTuner('executemany:hrsa.coveredentity', 1000, 100, 100000)
+
+    tuner.observe(10, 0.001)
+
+    assert tuner.size == 1000
+    assert tuner.best_rate == 0.0
+
+
+def test_tuner_shrinks_after_a_slow_batch():
+    tuner = BatchSizeTuner('executemany:hrsa.coveredentity', 8000, 100, 100000, max_seconds=30.0)
+
+    tuner.observe(8000, 31.0)
+    assert tuner.size == 4000
+    tuner.observe(4000, 45.0)
+    assert tuner.size == 2000
+    # A slow batch still shrinks the size after the tuner has settled
+    tuner.settled = True
+    tuner.observe(2000, 60.0)
+    assert tuner.size == 1000
+
+
+def test_tuner_stays_within_the_writer_range():
+    tuner = BatchSizeTuner('bcp:hrsa.coveredentity', 250000, 100, 300000)
+
+    sizes = tune(tuner)
+
+    assert max(sizes) <= 300000
+    assert 100 <= tuner.size <= 300000
+
+
+def test_batch_sizes_start_from_the_persisted_size_and_save_the_tuned_one(tmp_path):
+    path = tmp_path / 'batch_sizes.json'
+    path.write_text(json.dumps({'executemany:hrsa.coveredentity': 5000}))
+    writer = ExecutemanyWriter()
+    table = SimpleNamespace(fullname='hrsa.coveredentity')
+
+    batch_sizes = BatchSizes(str(path))
+    tuner = batch_sizes.tuner(writer, table)
+    assert tuner.size == 5000
+    # Searching around a persisted size starts with a smaller step
+    assert tuner.step == pytest.approx(2 ** 0.5)
+    assert batch_sizes.tuner(writer, SimpleNamespace(fullname='hrsa.ceparentchild')).size == writer.batch_size
+
+    tune(tuner)
+    batch_sizes.save()
+    assert json.loads(path.read_text())['executemany:hrsa.coveredentity'] == tuner.size
+
+
+def test_fixed_batch_sizes_use_the_writer_batch_size(tmp_path):
+    tuner = BatchSizes(adaptive=False).tuner(ExecutemanyWriter(batch_size=250), SimpleNamespace(fullname='hrsa.coveredentity'))
+
+    tuner.observe(250, 60.0)
+
+    assert tuner.settled
+    assert tuner.size == 250
+
+
+class SlowFailureWriter(ExecutemanyWriter):
+    # The first attempt hangs for a while and then loses the connection
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def _write(self, connection, table, columns, rows):
+        self.calls += 1
+        if self.calls == 1:
+            time.sleep(0.3)
+            raise DBAPIError('INSERT ...', None, Exception('08S01', 'Communication link failure (10054)'))
+        super()._write(connection, table, columns, rows)
+
+
+class RecordingTuner:
+    size = 1000
+
+    def __init__(self):
+        self.observed = []
+
+    def observe(self, rows, seconds):
+        self.observed.append((rows, seconds))
+
+
+def test_write_batches_times_only_the_attempt_that_wrote_the_batch(jetsons_engine, monkeypatch):
+    # No backoff between attempts; the writer's own sleep still takes its time
+    monkeypatch.setattr(checkpoint, 'time', SimpleNamespace(sleep=lambda seconds: None))
+    tuner = RecordingTuner()
+    batch_sizes = BatchSizes()
+    monkeypatch.setattr(batch_sizes, 'tuner', lambda writer, table: tuner)
+    jetson_datasource = JetsonDatasource(jetsons_engine, '0', writer=SlowFailureWriter(), batch_sizes=batch_sizes)
+    table = jetson_datasource.schema_cache.table('contractpharmacy')
+
+    with jetsons_engine.connect() as connection:
+        jetson_datasource.write_batches(connection, table, ['id', 'ncpdp'], [(1, '0000001'), (2, '0000002')], ['id'])
+
+    [(rows, seconds)] = tuner.observed
+    assert rows == 2
+    assert seconds < 0.3
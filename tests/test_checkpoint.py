@@ -0,0 +1,108 @@
+import pandas as pd
+import pytest
+from sqlalchemy import select
+from sqlalchemy.exc import DBAPIError
+
+import checkpoint
+from batch_sizing import BatchSizes
+from bulk_writer import ExecutemanyWriter
+from checkpoint import BatchJournal, is_transient, retry_transient
+from jetson_connection import JetsonDatasource
+
+
+class DriverError(Exception):
+    # Shaped like a pyodbc error: (SQLSTATE, message with the native error number)
+    pass
+
+
+def database_error(sqlstate, message, connection_invalidated=False):
+    return DBAPIError('INSERT ...', None, DriverError(sqlstate, message), connection_invalidated=connection_invalidated)
+
+
+@pytest.fixture
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(checkpoint.time, 'sleep', lambda seconds: None)
+
+
+@pytest.mark.parametrize('error, transient', [
+    (database_error('08S01', '[08S01] Communication link failure (10054)'), True),
+    (database_error('HYT00', '[HYT00] Query timeout expired (0)'), True),
+    (database_error('40001', '[40001] Transaction was deadlocked on lock resources (1205)'), True),
+    (database_error('42000', '[42000] The service is currently busy (40501)'), True),
+    (database_error('23000', '[23000] Violation of PRIMARY KEY constraint (2627)'), False),
+    (database_error('42S02', "[42S02] Invalid object name 'hrsa.missing' (208)"), False),
+    (database_error('HY000', 'The cursor is closed', connection_invalidated=True), True),
+])
+def test_is_transient(error, transient):
+    assert is_transient(error) is transient
+
+
+def test_retry_transient_retries_only_transient_errors(no_backoff):
+    failures = [database_error('08S01', 'Communication link failure (10054)')]
+    rollbacks = []
+
+    def operation():
+        if failures:
+            raise failures.pop()
+        return 'done'
+
+    assert retry_transient(operation, 'insert', before_retry=lambda: rollbacks.append(1)) == 'done'
+    assert rollbacks == [1]
+
+    def violates_key():
+        raise database_error('23000', 'Violation of PRIMARY KEY constraint (2627)')
+
+    with pytest.raises(DBAPIError):
+        retry_transient(violates_key, 'insert', before_retry=lambda: rollbacks.append(1))
+    assert rollbacks == [1]
+
+
+def test_resume_skips_rows_committed_by_the_failed_run(tmp_path):
+    path = str(tmp_path / 'journal.db')
+    journal = BatchJournal(path)
+    journal.record('hrsa.coveredentityidentifier', [(1, 'a'), (2, 'b')])
+    journal.close()
+    df = pd.DataFrame({'coveredEntityKeyId': [1, 2, 3], 'identifier': ['a', 'x', 'c']})
+
+    resumed = BatchJournal(path, resume=True)
+    remaining = resumed.skip_committed('hrsa.coveredentityidentifier', df, ['coveredEntityKeyId', 'identifier'])
+    resumed.close()
+    assert remaining['coveredEntityKeyId'].tolist() == [2, 3]
+
+    # A run started without --resume starts a new journal
+    BatchJournal(path).close()
+    assert len(BatchJournal(path, resume=True).skip_committed('hrsa.coveredentityidentifier', df, ['coveredEntityKeyId', 'identifier'])) == 3
+
+
+class DroppedAfterCommitWriter(ExecutemanyWriter):
+    # Commits the first batch on the server, then loses the connection before the client hears back
+    def __init__(self, fail_after_commit):
+        super().__init__()
+        self.fail_after_commit = fail_after_commit
+        self.calls = 0
+
+    def _write(self, connection, table, columns, rows):
+        self.calls += 1
+        if self.calls == 1:
+            if self.fail_after_commit:
+                super()._write(connection, table, columns, rows)
+                connection.commit()
+            raise database_error('08S01', 'Communication link failure (10054)')
+        super()._write(connection, table, columns, rows)
+
+
+@pytest.mark.parametrize('fail_after_commit, writes', [(True, 1), (False, 2)])
+def test_write_batch_does_not_rewrite_a_batch_committed_before_the_error(jetsons_engine, no_backoff, fail_after_commit, writes):
+    writer = DroppedAfterCommitWriter(fail_after_commit)
+    jetson_datasource = JetsonDatasource(jetsons_engine, '0', writer=writer, batch_sizes=BatchSizes(adaptive=False))
+    table = jetson_datasource.schema_cache.table('coveredentityidentifier')
+    columns = ['id', 'coveredEntityKeyId', 'identifier']
+    batch = [(1, 10, 'a'), (2, 11, 'b')]
+
+    with jetsons_engine.connect() as connection:
+        jetson_datasource.write_batch(connection, table, columns, batch, ['coveredEntityKeyId', 'identifier'])
+
+    with jetsons_engine.connect() as connection:
+        stored = connection.execute(select(table.c.id, table.c.coveredEntityKeyId, table.c.identifier).order_by(table.c.id)).fetchall()
+    assert [tuple(row) for row in stored] == batch
+    assert writer.calls == writes
@@ -0,0 +1,91 @@
+import threading
+
+from sqlalchemy import event, insert
+
+from id_allocator import IdAllocator
+from schema_cache import SchemaCache
+
+
+def interfere_once(engine, statement_prefix, interfere):
+    # Runs interfere() just before the first statement starting with statement_prefix,
+    # as if another writer had got there first
+    fired = []
+
+    @event.listens_for(engine, 'before_cursor_execute')
+    def before(connection, cursor, statement, parameters, context, executemany):
+        if not fired and statement.lstrip().upper().startswith(statement_prefix):
+            # Marked first, so the other writer's own statement doesn't trigger it again
+            fired.append(None)
+            fired[0] = interfere()
+
+    return fired
+
+
+def assert_disjoint(ranges):
+    ranges = sorted(ranges, key=lambda reserved: reserved.start)
+    for previous, current in zip(ranges, ranges[1:]):
+        assert previous.stop <= current.start, f"{previous} overlaps {current}"
+
+
+def test_concurrent_reservations_never_overlap(jetsons_engine):
+    table = SchemaCache(jetsons_engine).table('coveredentity')
+    allocator = IdAllocator(jetsons_engine, retries=20)
+    ranges = []
+    errors = []
+    start = threading.Barrier(2)
+
+    def reserve(count):
+        start.wait()
+        try:
+            for _ in range(10):
+                first_id = allocator.reserve(table, 'ID', count)
+                ranges.append(range(first_id, first_id + count))
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=reserve, args=(count,)) for count in (7, 100)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not errors
+    assert len(ranges) == 20
+    assert_disjoint(ranges)
+
+
+def test_first_reservation_retries_when_another_writer_inserts_the_row_first(jetsons_engine):
+    table = SchemaCache(jetsons_engine).table('coveredentity')
+    other_allocator = IdAllocator(jetsons_engine)
+    fired = interfere_once(jetsons_engine, 'INSERT INTO HRSA.ID_RESERVATION', lambda: other_allocator.reserve(table, 'ID', 10))
+
+    first_id = IdAllocator(jetsons_engine).reserve(table, 'ID', 5)
+
+    # The other writer's insert made this one's fail with an IntegrityError; the retry swapped
+    assert fired == [1]
+    assert first_id == 11
+
+
+def test_reservation_retries_when_another_writer_swaps_first(jetsons_engine):
+    table = SchemaCache(jetsons_engine).table('coveredentity')
+    allocator = IdAllocator(jetsons_engine)
+    assert allocator.reserve(table, 'ID', 10) == 1
+    other_allocator = IdAllocator(jetsons_engine)
+    fired = interfere_once(jetsons_engine, 'UPDATE HRSA.ID_RESERVATION', lambda: other_allocator.reserve(table, 'ID', 10))
+
+    first_id = allocator.reserve(table, 'ID', 5)
+
+    assert fired == [11]
+    assert_disjoint([range(1, 11), range(11, 21), range(first_id, first_id + 5)])
+    assert first_id == 21
+
+
+def test_reservations_start_above_ids_assigned_without_the_allocator(jetsons_engine):
+    table = SchemaCache(jetsons_engine).table('coveredentity')
+    allocator = IdAllocator(jetsons_engine)
+    assert allocator.reserve(table, 'ID', 10) == 1
+    with jetsons_engine.begin() as connection:
+        connection.execute(insert(table).values(ID=500, id340B='DSH00000500'))
+
+    assert allocator.reserve(table, 'ID', 10) == 501
+    assert allocator.reserve(table, 'ID', 10) == 511
@@ -0,0 +1,58 @@
+from datetime import datetime, timedelta
+
+import pandas as pd
+from sqlalchemy import insert
+
+from id_index import CoveredEntityIndex
+from schema_cache import SchemaCache
+
+
+def add_covered_entities(engine, table, first_id, count, last_updated):
+    with engine.begin() as connection:
+        connection.execute(insert(table), [
+            {'ID': first_id + i, 'id340B': f"DSH{first_id + i:08d}", 'lastUpdatedDate': last_updated}
+            for i in range(count)
+        ])
+
+
+def test_refresh_reads_only_rows_the_index_has_not_seen(jetsons_engine):
+    schema_cache = SchemaCache(jetsons_engine)
+    table = schema_cache.table('coveredentity')
+    index = CoveredEntityIndex(schema_cache)
+    now = datetime.now()
+    add_covered_entities(jetsons_engine, table, 1, 100, now)
+
+    with jetsons_engine.connect() as connection:
+        assert index.refresh(connection) == 100
+        # Rows this process inserted itself are never read back, even though they are
+        # stamped within the refresh overlap
+        add_covered_entities(jetsons_engine, table, 101, 50, now)
+        index.update(((f"DSH{i:08d}", i) for i in range(101, 151)), last_updated=now)
+        assert index.refresh(connection) == 0
+        # Rows another writer inserted are
+        add_covered_entities(jetsons_engine, table, 151, 10, now - timedelta(days=1))
+        assert index.refresh(connection) == 10
+
+    assert index.map(pd.Series(['DSH00000001', 'DSH00000160', 'DSH99999999'])).tolist() == [1, 160, pd.NA]
+
+
+def test_persisted_index_catches_up_by_last_updated_date(jetsons_engine, tmp_path):
+    schema_cache = SchemaCache(jetsons_engine)
+    table = schema_cache.table('coveredentity')
+    path = str(tmp_path / 'id_index.db')
+    now = datetime.now()
+    add_covered_entities(jetsons_engine, table, 1, 10, now)
+    add_covered_entities(jetsons_engine, table, 1000, 5, now)
+    index = CoveredEntityIndex(schema_cache, path=path)
+    with jetsons_engine.connect() as connection:
+        index.refresh(connection)
+    index.save()
+
+    # A range reserved below the index's highest ID but only inserted after it was saved
+    add_covered_entities(jetsons_engine, table, 500, 5, now)
+
+    index = CoveredEntityIndex(schema_cache, path=path)
+    with jetsons_engine.connect() as connection:
+        assert index.refresh(connection) == 20
+        assert index.refresh(connection) == 0
+    assert index.map(pd.Series(['DSH00000500', 'DSH00001004'])).tolist() == [500, 1004]
@@ -0,0 +1,26 @@
+import time
+
+import numpy as np
+import pytest
+
+from instrumentation import RunMetrics, current_memory_bytes
+
+
+def test_measure_records_the_peak_memory_of_each_call():
+    if current_memory_bytes() is None:
+        pytest.skip("resident memory can't be read on this platform")
+    metrics = RunMetrics()
+    with metrics.stage('covered_entities'):
+        with metrics.measure('fetch', rows=1):
+            # Allocated and freed again within the call, like a fetch's Arrow buffers
+            buffer = np.ones(64 * 2**20, dtype=np.uint8)
+            time.sleep(0.1)
+            del buffer
+        with metrics.measure('clean', rows=1):
+            time.sleep(0.1)
+
+    steps = metrics.report()['stages']['covered_entities']['steps']
+    assert steps['fetch']['peak_growth_bytes'] >= 60 * 2**20
+    assert steps['clean']['peak_growth_bytes'] < 16 * 2**20
+    assert steps['fetch']['peak_memory_bytes'] > steps['clean']['peak_memory_bytes']
+    assert [batch['step'] for batch in metrics.batches] == ['fetch', 'clean']
@@ -0,0 +1,37 @@
+import pandas as pd
+from sqlalchemy import insert
+
+from batch_sizing import BatchSizes
+from jetson_connection import JetsonDatasource
+
+
+def add_covered_entities(jetson_datasource, count):
+    with jetson_datasource.sql_server_engine.begin() as connection:
+        connection.execute(insert(jetson_datasource.schema_cache.table('coveredentity')), [
+            {'ID': i, 'id340B': f"DSH{i:08d}"} for i in range(1, count + 1)
+        ])
+
+
+def test_ce_parents_dedup_is_measured_once_per_chunk(jetsons_engine):
+    jetson_datasource = JetsonDatasource(jetsons_engine, '0', batch_sizes=BatchSizes(adaptive=False))
+    add_covered_entities(jetson_datasource, 1001)
+    ce_parents_df = pd.DataFrame({
+        'parentId340B': 'DSH00000001',
+        'id340B': [f"DSH{i:08d}" for i in range(2, 1002)],
+    })
+
+    jetson_datasource.insert_ce_parents(ce_parents_df)
+
+    dedup = jetson_datasource.metrics.report()['stages']['other']['steps']['dedup']
+    assert (dedup['calls'], dedup['rows']) == (1, 1000)
+    assert jetson_datasource.insert_counts['hrsa.ceparentchild']['inserted'] == 1000
+
+
+def test_compare_measures_dedup_once(jetsons_engine):
+    jetson_datasource = JetsonDatasource(jetsons_engine, '0')
+    add_covered_entities(jetson_datasource, 10)
+
+    jetson_datasource.compare('covered_entities', pd.DataFrame({'id340B': [f"DSH{i:08d}" for i in range(6, 16)]}))
+
+    dedup = jetson_datasource.metrics.report()['stages']['other']['steps']['dedup']
+    assert (dedup['calls'], dedup['rows']) == (1, 10)
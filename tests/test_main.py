@@ -0,0 +1,59 @@
+from contextlib import nullcontext
+
+import pandas as pd
+
+from extract_cache import ExtractCacheMiss
+from main import transfer
+
+
+class CachedOnlyDatasource:
+    # Serves cached extracts for some entities and misses for the rest, like --load-only
+    def __init__(self, cached):
+        self.cached = cached
+
+    def __getattr__(self, name):
+        entity = name[len('get_'):]
+
+        def get():
+            if entity not in self.cached:
+                raise ExtractCacheMiss("No fresh cached extract")
+            return pd.DataFrame({'id340B': ['DSH00000001']})
+        return get
+
+    def close(self):
+        pass
+
+
+class RecordingJetsonDatasource:
+    def __init__(self):
+        self.loaded = []
+
+    def __getattr__(self, name):
+        return lambda df: self.loaded.append(name) or df
+
+    def stage_connection(self):
+        return nullcontext()
+
+    def unmapped_rows(self, entity):
+        return 0
+
+
+class RecordingSyncState:
+    def __init__(self):
+        self.committed = []
+
+    def commit(self, entity):
+        self.committed.append(entity)
+
+
+def test_load_only_skips_entities_without_a_cached_extract():
+    jetson_datasource = RecordingJetsonDatasource()
+    sync_state = RecordingSyncState()
+
+    stats = transfer(lambda: CachedOnlyDatasource({'ce_parents', 'contract_pharmacies'}), jetson_datasource,
+                     sync_state=sync_state)
+
+    # The other stages still load, but nothing that depends on the skipped one is marked as synced
+    assert stats['covered entities']['extract_missing']
+    assert sorted(jetson_datasource.loaded) == ['insert_ce_parents', 'insert_contract_pharmacies']
+    assert sync_state.committed == ['contract_pharmacies']
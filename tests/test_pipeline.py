@@ -0,0 +1,130 @@
+import threading
+import time
+
+import pandas as pd
+import pytest
+
+from pipeline import TransferPipeline
+
+
+def chunks(*sizes):
+    return lambda: (pd.DataFrame({'id': range(size)}) for size in sizes)
+
+
+def test_dependent_load_waits_for_its_dependency():
+    events = []
+    lock = threading.Lock()
+
+    def load(name, delay=0.0):
+        def run(chunk):
+            time.sleep(delay)
+            with lock:
+                events.append(name)
+            return chunk
+        return run
+
+    pipeline = TransferPipeline()
+    covered_entities = pipeline.add_stage('covered entities', chunks(10, 10, 10), load('covered entities', delay=0.05))
+    dependent_started = []
+
+    def load_ce_parents(chunk):
+        # Every covered entity chunk was loaded and the stage marked as such before this runs
+        dependent_started.append(covered_entities.loaded.is_set())
+        return load('CE parents')(chunk)
+
+    pipeline.add_stage('CE parents', chunks(5, 5), load_ce_parents, after=['covered entities'])
+    stats = pipeline.run()
+
+    assert dependent_started == [True, True]
+    assert events == ['covered entities'] * 3 + ['CE parents'] * 2
+    assert stats['covered entities']['rows'] == 30
+    assert stats['CE parents']['chunks'] == 2
+
+
+def test_unknown_dependency_is_rejected():
+    pipeline = TransferPipeline()
+    with pytest.raises(ValueError):
+        pipeline.add_stage('CE parents', chunks(1), lambda chunk: chunk, after=['covered entities'])
+
+
+def test_max_workers_limits_concurrent_loads():
+    running = []
+    peak = []
+    lock = threading.Lock()
+
+    def load(chunk):
+        with lock:
+            running.append(1)
+            peak.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return chunk
+
+    pipeline = TransferPipeline(max_workers=2)
+    for name in ('a', 'b', 'c', 'd'):
+        pipeline.add_stage(name, chunks(1, 1), load)
+    pipeline.run()
+
+    assert max(peak) == 2
+
+
+def test_failed_load_aborts_the_run_and_is_reraised():
+    loaded = []
+
+    def failing_load(chunk):
+        raise RuntimeError('insert failed')
+
+    def slow_extract():
+        for _ in range(100):
+            time.sleep(0.01)
+            yield pd.DataFrame({'id': [1]})
+
+    pipeline = TransferPipeline()
+    pipeline.add_stage('covered entities', chunks(1), failing_load)
+    pipeline.add_stage('CE parents', chunks(1), lambda chunk: loaded.append('CE parents'), after=['covered entities'])
+    pipeline.add_stage('contract pharmacies', slow_extract, lambda chunk: loaded.append('contract pharmacies'))
+
+    started = time.perf_counter()
+    with pytest.raises(RuntimeError, match='insert failed'):
+        pipeline.run()
+
+    # The dependent stage never loads, and the independent one stops early
+    assert 'CE parents' not in loaded
+    assert loaded.count('contract pharmacies') < 100
+    assert time.perf_counter() - started < 1
+    assert pipeline.errors[0][0] == 'covered entities'
+
+
+def test_failed_dependent_stage_is_reraised():
+    def failing_load(chunk):
+        raise RuntimeError('CE parents failed')
+
+    pipeline = TransferPipeline()
+    pipeline.add_stage('covered entities', chunks(1), lambda chunk: chunk)
+    pipeline.add_stage('CE parents', chunks(1), failing_load, after=['covered entities'])
+
+    with pytest.raises(RuntimeError, match='CE parents failed'):
+        pipeline.run()
+
+
+def test_failed_extract_is_reraised():
+    def failing_extract():
+        yield pd.DataFrame({'id': [1]})
+        raise ConnectionError('Snowflake went away')
+
+    pipeline = TransferPipeline()
+    pipeline.add_stage('covered entities', failing_extract, lambda chunk: chunk)
+
+    with pytest.raises(ConnectionError):
+        pipeline.run()
+
+
+def test_chunk_that_returns_none_is_counted_as_failed():
+    pipeline = TransferPipeline()
+    pipeline.add_stage('covered entities', chunks(3, 4), lambda chunk: None if len(chunk) == 3 else chunk)
+
+    stats = pipeline.run()
+
+    assert stats['covered entities']['failed_chunks'] == 1
+    assert stats['covered entities']['rows'] == 7